@@ -0,0 +1,143 @@
+import time
+import logging
+from collections import deque
+from statistics import median
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Quality level that hands scale, JPEG quality and frame rate to the server
+AUTO_QUALITY = 0
+
+# Round-trip time from frame emit to controller ack the controller steers toward
+TARGET_LATENCY = 0.15  # seconds
+
+ADJUST_INTERVAL = 1.0  # seconds between decisions
+MIN_SAMPLES = 3  # acks needed before a period counts
+STABLE_PERIODS = 3  # good periods in a row before stepping up
+
+# Throughput at which latency last went bad is taken as the link's capacity for a while
+CEILING_MARGIN = 0.8  # step up only while the next rung's expected rate stays below this share of it
+CEILING_TTL = 30.0  # seconds before the ceiling is forgotten and higher rungs are probed again
+
+
+class AdaptiveStep(NamedTuple):
+    """One rung of the adaptive quality ladder"""
+    scale: float
+    quality: int
+    fps: int
+
+    def cost(self) -> float:
+        """Rough relative bytes per second of this rung: pixels, quality and frame rate"""
+        return self.scale ** 2 * self.quality * self.fps
+
+
+# Cheapest first; congestion steps down quickly, headroom steps up slowly
+ADAPTIVE_LADDER = [
+    AdaptiveStep(0.25, 30, 10),
+    AdaptiveStep(0.5, 40, 15),
+    AdaptiveStep(0.5, 60, 20),
+    AdaptiveStep(0.75, 60, 24),
+    AdaptiveStep(1.0, 70, 30),
+    AdaptiveStep(1.0, 85, 30),
+]
+START_STEP = 3
+
+
+class AdaptiveQuality:
+    """Per-controller AIMD controller moving along ADAPTIVE_LADDER toward a target latency"""
+
+    def __init__(self, target_latency: float = TARGET_LATENCY):
+        self.target_latency = target_latency
+        self.step = START_STEP
+        self._rtts = []
+        self._delivery_times = []
+        self._timeouts = 0
+        self._bytes = 0
+        self._period_start = time.time()
+        self._good_periods = 0
+        self.rtt: Optional[float] = None  # median of the last period
+        self.throughput = 0.0  # bytes per second in the last period
+        self.ceiling: Optional[float] = None  # bytes per second at the last congestion
+        self._ceiling_at = 0.0
+        self.history = deque(maxlen=20)  # recent decisions
+
+    @property
+    def current(self) -> AdaptiveStep:
+        return ADAPTIVE_LADDER[self.step]
+
+    def record_sent(self, size: int, delivery_time: float) -> None:
+        """Record an emitted frame and how long it took from the start of encoding to emit"""
+        self._bytes += size
+        self._delivery_times.append(delivery_time)
+
+    def record_ack(self, rtt: float) -> None:
+        """Record the time from emitting a frame to the controller acknowledging it"""
+        self._rtts.append(rtt)
+
+    def record_timeout(self) -> None:
+        """Record a frame that was never acknowledged"""
+        self._timeouts += 1
+
+    def update(self, now: float) -> Optional[dict]:
+        """Close a measurement period if one is due, returning a decision if the step changed"""
+        elapsed = now - self._period_start
+        if elapsed < ADJUST_INTERVAL:
+            return None
+
+        rtts, delivery_times, timeouts = self._rtts, self._delivery_times, self._timeouts
+        self.throughput = self._bytes / elapsed
+        self._rtts, self._delivery_times, self._timeouts, self._bytes = [], [], 0, 0
+        self._period_start = now
+        if len(rtts) < MIN_SAMPLES and not timeouts:
+            return None  # idle or too few frames to judge
+
+        self.rtt = median(rtts) if rtts else None
+        delivery = median(delivery_times) if delivery_times else 0.0
+        step, reason = self.step, None
+        if timeouts or (self.rtt is not None and self.rtt > self.target_latency * 2):
+            step, reason = self.step - 2, 'congested'
+            self._set_ceiling(now)
+        elif self.rtt is not None and self.rtt > self.target_latency:
+            step, reason = self.step - 1, 'latency above target'
+            self._set_ceiling(now)
+        elif delivery > self.target_latency / 2:
+            step, reason = self.step - 1, 'encoder busy'
+        elif self.rtt is not None and self.rtt < self.target_latency / 2:
+            self._good_periods += 1
+            if self._good_periods >= STABLE_PERIODS and self._fits_next_step(now):
+                step, reason = self.step + 1, 'headroom'
+        else:
+            self._good_periods = 0
+
+        step = max(0, min(step, len(ADAPTIVE_LADDER) - 1))
+        if step == self.step:
+            return None
+        self.step = step
+        self._good_periods = 0
+        decision = {
+            'scale': self.current.scale,
+            'quality': self.current.quality,
+            'fps': self.current.fps,
+            'rtt_ms': round(self.rtt * 1000) if self.rtt is not None else None,
+            'throughput_kbps': round(self.throughput * 8 / 1000),
+            'reason': reason
+        }
+        self.history.append(decision)
+        logger.info(f"Adaptive quality step {step}: {decision}")
+        return decision
+
+    def _set_ceiling(self, now: float) -> None:
+        """Remember the throughput at which latency went bad"""
+        if self.throughput > 0:
+            self.ceiling = self.throughput
+            self._ceiling_at = now
+
+    def _fits_next_step(self, now: float) -> bool:
+        """Check whether the next rung's expected throughput stays clear of the last congestion"""
+        if self.step + 1 >= len(ADAPTIVE_LADDER):
+            return False
+        if self.ceiling is None or now - self._ceiling_at > CEILING_TTL:
+            return True
+        expected = self.throughput * ADAPTIVE_LADDER[self.step + 1].cost() / self.current.cost()
+        return expected < self.ceiling * CEILING_MARGIN
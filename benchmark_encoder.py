@@ -0,0 +1,118 @@
+import sys
+import time
+import argparse
+import logging
+
+import numpy as np
+from PIL import Image
+from mss.screenshot import ScreenShot
+
+from screen_capture import CaptureEngine, CapturedFrame
+from frame_diff import TILE_SIZE, frame_bgra
+from frame_encoder import frame_to_image
+from image_codecs import get_codec, JPEG_SUBSAMPLING_MODES
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def synthetic_frame(width, height):
+    """Build a desktop-like BGRA frame: flat background, text-like noise and a photo area"""
+    rng = np.random.default_rng(0)
+    pixels = np.full((height, width), 0xFFF0F0F0, dtype=np.uint32)
+    text = rng.random((height // 2, width // 2)) < 0.1
+    pixels[:height // 2, :width // 2][text] = 0xFF202060
+    pixels[height // 2:, width // 2:] = rng.integers(0, 2 ** 32, (height - height // 2, width - width // 2),
+                                                     dtype=np.uint32) | 0xFF000000
+    return CapturedFrame(1, {'left': 0, 'top': 0, 'width': width, 'height': height},
+                         (width, height), bytearray(pixels.tobytes()))
+
+
+def legacy_encode(frame, quality):
+    """Original path: screenshot.rgb copy, Image.frombytes copy, then PIL JPEG"""
+    screenshot = ScreenShot(frame.raw, frame.monitor)
+    img = Image.frombytes('RGB', screenshot.size, screenshot.rgb)
+    return get_codec('jpeg').encode(img, quality)
+
+
+def pillow_encode(frame, quality):
+    """Pillow path: decode the BGRX buffer once, then PIL JPEG"""
+    return get_codec('jpeg').encode(frame_to_image(frame), quality)
+
+
+def turbo_encode(frame, quality):
+    """libjpeg-turbo path: encode straight from the BGRA buffer"""
+    return get_codec('jpeg').encode_pixels(frame_bgra(frame), quality)
+
+
+def tile_views(frame):
+    """Strided TILE_SIZE views into the frame, as dirty-region updates encode them"""
+    bgra = frame_bgra(frame)
+    return [bgra[y:y + TILE_SIZE, x:x + TILE_SIZE]
+            for y in range(0, frame.height, TILE_SIZE) for x in range(0, frame.width, TILE_SIZE)]
+
+
+def pillow_tiles_encode(frame, quality):
+    """Pillow path per tile: crop the decoded frame, then PIL JPEG"""
+    img = frame_to_image(frame)
+    jpeg = get_codec('jpeg')
+    return b''.join(jpeg.encode(img.crop((x, y, x + TILE_SIZE, y + TILE_SIZE)), quality)
+                    for y in range(0, frame.height, TILE_SIZE) for x in range(0, frame.width, TILE_SIZE))
+
+
+def turbo_tiles_encode(frame, quality):
+    """libjpeg-turbo path per tile: encode each non-contiguous tile view of the buffer"""
+    jpeg = get_codec('jpeg')
+    tiles = [jpeg.encode_pixels(tile, quality) for tile in tile_views(frame)]
+    return None if tiles[0] is None else b''.join(tiles)
+
+
+def run(name, encode, frame, quality, iterations):
+    """Time an encode path and log its speed and output size"""
+    data = encode(frame, quality)
+    if data is None:
+        logger.info(f"{name:<10} not available")
+        return
+    started = time.perf_counter()
+    for _ in range(iterations):
+        encode(frame, quality)
+    elapsed = (time.perf_counter() - started) / iterations
+    logger.info(f"{name:<10} {elapsed * 1000:7.2f} ms/frame  {len(data) / 1024:8.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JPEG encoding paths for captured frames")
+    parser.add_argument('--capture', action='store_true', help="Use a real screen grab instead of a synthetic frame")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--quality', type=int, default=70)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.capture:
+        engine = CaptureEngine()
+        frame = engine.grab()
+        engine.stop()
+        if frame is None:
+            logger.error("Screen capture failed")
+            return False
+    else:
+        frame = synthetic_frame(args.width, args.height)
+
+    logger.info(f"Frame {frame.width}x{frame.height}, quality {args.quality}")
+    jpeg = get_codec('jpeg')
+    for subsampling in JPEG_SUBSAMPLING_MODES:
+        jpeg.subsampling = subsampling
+        logger.info(f"--- subsampling {subsampling}")
+        run('legacy', legacy_encode, frame, args.quality, args.iterations)
+        run('pillow', pillow_encode, frame, args.quality, args.iterations)
+        run('turbojpeg', turbo_encode, frame, args.quality, args.iterations)
+        run('pil tiles', pillow_tiles_encode, frame, args.quality, args.iterations)
+        run('tj tiles', turbo_tiles_encode, frame, args.quality, args.iterations)
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
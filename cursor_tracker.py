@@ -0,0 +1,116 @@
+import io
+import zlib
+import logging
+from typing import Optional, Dict
+
+import numpy as np
+import win32con
+import win32gui
+import win32ui
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Number of distinct cursor handles whose rendered shape is kept
+MAX_CACHED_SHAPES = 64
+
+
+class CursorShape:
+    """Rendered cursor image identified by a hash of its pixels"""
+
+    def __init__(self, data: bytes, width: int, height: int, hotspot_x: int, hotspot_y: int):
+        self.shape_id = zlib.crc32(data)
+        self.data = data  # PNG with alpha
+        self.width = width
+        self.height = height
+        self.hotspot_x = hotspot_x
+        self.hotspot_y = hotspot_y
+
+
+class CursorState:
+    """Cursor position in virtual screen pixels and the shape it shows"""
+
+    def __init__(self, x: int, y: int, visible: bool, shape: Optional[CursorShape]):
+        self.x = x
+        self.y = y
+        self.visible = visible
+        self.shape = shape
+
+
+class CursorTracker:
+    """Poll the host cursor so it can be sent separately from frames"""
+
+    def __init__(self):
+        self._shapes: Dict[int, Optional[CursorShape]] = {}  # cursor handle -> shape
+        self._failing = False  # log read errors once, not on every poll
+
+    def poll(self) -> Optional[CursorState]:
+        """Read the current cursor position and shape"""
+        try:
+            flags, handle, (x, y) = win32gui.GetCursorInfo()
+            visible = bool(flags & win32con.CURSOR_SHOWING)
+            shape = self._get_shape(handle) if visible and handle else None
+            self._failing = False
+            return CursorState(x, y, visible, shape)
+        except Exception as e:
+            # Fails e.g. while the secure desktop (UAC, lock screen) is active
+            if not self._failing:
+                logger.error(f"Error reading cursor: {e}")
+                self._failing = True
+            return None
+
+    def _get_shape(self, handle: int) -> Optional[CursorShape]:
+        """Rendered shape of a cursor handle, rendering it on first use"""
+        if handle not in self._shapes:
+            if len(self._shapes) >= MAX_CACHED_SHAPES:
+                self._shapes.clear()
+            self._shapes[handle] = self._render(handle)
+        return self._shapes[handle]
+
+    @staticmethod
+    def _render(handle: int) -> Optional[CursorShape]:
+        """Draw a cursor into a PNG, recovering alpha from black and white backgrounds"""
+        screen_dc = None
+        try:
+            # The returned bitmap handles free themselves when collected
+            _, hotspot_x, hotspot_y, mask_bitmap, _ = win32gui.GetIconInfo(handle)
+            size = win32gui.GetObject(mask_bitmap).bmWidth
+
+            screen_dc = win32gui.GetDC(0)
+            dc = win32ui.CreateDCFromHandle(screen_dc)
+            layers = []
+            for background in (0x000000, 0xFFFFFF):
+                memory_dc = dc.CreateCompatibleDC()
+                bitmap = win32ui.CreateBitmap()
+                bitmap.CreateCompatibleBitmap(dc, size, size)
+                memory_dc.SelectObject(bitmap)
+                memory_dc.FillSolidRect((0, 0, size, size), background)
+                win32gui.DrawIconEx(memory_dc.GetSafeHdc(), 0, 0, handle, size, size, 0, None,
+                                    win32con.DI_NORMAL)
+                bits = bitmap.GetBitmapBits(True)
+                layers.append(np.frombuffer(bits, dtype=np.uint8).reshape(size, size, 4)[:, :, 2::-1])
+                memory_dc.DeleteDC()
+                win32gui.DeleteObject(bitmap.GetHandle())
+
+            on_black, on_white = (layer.astype(np.int32) for layer in layers)
+            difference = on_white - on_black
+            alpha = np.clip(255 - difference.max(axis=2), 0, 255)
+            rgba = np.zeros((size, size, 4), dtype=np.uint8)
+            visible = alpha > 0
+            rgba[visible, :3] = np.clip(on_black[visible] * 255 // alpha[visible, None], 0, 255)
+            # Inverting (XOR) pixels have no RGBA equivalent; draw them opaque black,
+            # which is how they look over the light backgrounds they are mostly used on
+            inverted = difference.min(axis=2) < 0
+            rgba[inverted, :3] = 0
+            alpha[inverted] = 255
+            rgba[:, :, 3] = alpha
+
+            output = io.BytesIO()
+            Image.fromarray(rgba, 'RGBA').save(output, format='PNG')
+            return CursorShape(output.getvalue(), size, size, hotspot_x, hotspot_y)
+        except Exception as e:
+            logger.error(f"Error rendering cursor shape: {e}")
+            return None
+        finally:
+            if screen_dc:
+                win32gui.ReleaseDC(0, screen_dc)
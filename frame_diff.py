@@ -0,0 +1,238 @@
+import zlib
+import logging
+from typing import Optional, List, Tuple, Dict
+
+import numpy as np
+
+from screen_capture import CapturedFrame
+
+logger = logging.getLogger(__name__)
+
+# Edge length of the square tiles frames are compared in
+TILE_SIZE = 64
+
+# Scroll and move detection
+MIN_MOVE_TILES = 4  # dirty tiles before looking for a shifted block
+MIN_MOVE_SIZE = 64  # smallest shifted run of rows/columns worth a copy
+MIN_MOVE_VOTES = 8  # matching lines needed to trust a shift
+MOVE_HASH_STRIDE = 4  # sample every Nth pixel along a line when hashing
+
+_hash_weights: Dict[int, np.ndarray] = {}
+
+
+def frame_pixels(frame: CapturedFrame) -> np.ndarray:
+    """View the raw BGRA buffer as a (height, width) array of 32-bit pixels"""
+    return np.frombuffer(frame.raw, dtype=np.uint32).reshape(frame.height, frame.width)
+
+
+def frame_bgra(frame: CapturedFrame) -> np.ndarray:
+    """View the raw BGRA buffer as a (height, width, 4) array of bytes"""
+    # Sliced tiles of this view stay valid byte arrays; re-viewing a slice of the 32-bit
+    # view as bytes needs NumPy 1.23+
+    return np.frombuffer(frame.raw, dtype=np.uint8).reshape(frame.height, frame.width, 4)
+
+
+def tile_rects(mask: np.ndarray, width: int, height: int, tile_size: int = TILE_SIZE,
+               merge: bool = True) -> List[Tuple[int, int, int, int]]:
+    """Turn a tile mask into (x, y, w, h) rectangles, merging horizontal runs unless told not to"""
+    rects = []
+    for row in range(mask.shape[0]):
+        cols = np.flatnonzero(mask[row])
+        if not len(cols):
+            continue
+        if not merge:
+            # Single tiles keep their content comparable across frames and positions
+            y = row * tile_size
+            h = min(tile_size, height - y)
+            rects.extend((int(col) * tile_size, y, min(tile_size, width - int(col) * tile_size), h)
+                         for col in cols)
+            continue
+        # Split the dirty columns of this row into contiguous runs
+        breaks = np.flatnonzero(np.diff(cols) > 1)
+        starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+        ends = np.concatenate((cols[breaks], [cols[-1]]))
+        y = row * tile_size
+        h = min(tile_size, height - y)
+        for start, end in zip(starts, ends):
+            x = int(start) * tile_size
+            w = min((int(end) + 1) * tile_size, width) - x
+            rects.append((x, y, w, h))
+    return rects
+
+
+def _line_hashes(block: np.ndarray, axis: int) -> np.ndarray:
+    """Hash every row (axis=1) or column (axis=0) of a pixel block"""
+    samples = block[:, ::MOVE_HASH_STRIDE] if axis == 1 else block[::MOVE_HASH_STRIDE, :]
+    length = samples.shape[axis]
+    weights = _hash_weights.get(length)
+    if weights is None:
+        weights = np.random.default_rng(length).integers(1, 2 ** 63, size=length, dtype=np.uint64) | 1
+        _hash_weights[length] = weights
+    # Integer overflow is intended: the sums only need to tell lines apart
+    with np.errstate(over='ignore'):
+        return samples.dot(weights) if axis == 1 else weights.dot(samples)
+
+
+def _find_shift(previous: np.ndarray, current: np.ndarray) -> Optional[Tuple[int, int, int]]:
+    """Find the dominant shift between two line hash arrays as (shift, start, end) of the run"""
+    values, index, counts = np.unique(previous, return_index=True, return_counts=True)
+    # Repeated lines (blank areas) would vote for any shift
+    values, index = values[counts == 1], index[counts == 1]
+    if not len(values):
+        return None
+    pos = np.minimum(np.searchsorted(values, current), len(values) - 1)
+    found = values[pos] == current
+    shifts = np.flatnonzero(found) - index[pos[found]]
+    shifts = shifts[shifts != 0]
+    if len(shifts) < MIN_MOVE_VOTES:
+        return None
+    candidates, votes = np.unique(shifts, return_counts=True)
+    if votes.max() < MIN_MOVE_VOTES:
+        return None
+    shift = int(candidates[votes.argmax()])
+
+    # Longest run of lines that match at this shift
+    length = len(current)
+    lines = np.arange(max(0, shift), min(length, length + shift))
+    equal = np.concatenate(([False], current[lines] == previous[lines - shift], [False]))
+    edges = np.flatnonzero(np.diff(equal.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    if not len(starts):
+        return None
+    best = int(np.argmax(ends - starts))
+    start, end = int(lines[starts[best]]), int(lines[ends[best] - 1]) + 1
+    if end - start < MIN_MOVE_SIZE:
+        return None
+    return shift, start, end
+
+
+def find_move(current: np.ndarray, previous: np.ndarray,
+              bounds: Tuple[int, int, int, int]) -> Optional[Tuple[int, int, int, int, int, int]]:
+    """Find a vertically or horizontally shifted block inside (x, y, w, h) bounds
+
+    Returns (src_x, src_y, x, y, w, h) in pixels, verified to match exactly.
+    """
+    x0, y0, width, height = bounds
+    cur = current[y0:y0 + height, x0:x0 + width]
+    prev = previous[y0:y0 + height, x0:x0 + width]
+
+    for axis in (1, 0):
+        found = _find_shift(_line_hashes(prev, axis), _line_hashes(cur, axis))
+        if found is None:
+            continue
+        shift, start, end = found
+        if axis == 1:
+            move = (x0, y0 + start - shift, x0, y0 + start, width, end - start)
+        else:
+            move = (x0 + start - shift, y0, x0 + start, y0, end - start, height)
+        src_x, src_y, x, y, w, h = move
+        if np.array_equal(current[y:y + h, x:x + w], previous[src_y:src_y + h, src_x:src_x + w]):
+            return move
+    return None
+
+
+class TileTracker:
+    """Track which fixed-size tiles of a frame changed and when"""
+
+    def __init__(self, tile_size: int = TILE_SIZE):
+        self.tile_size = tile_size
+        self._previous: Optional[np.ndarray] = None
+        self._versions: Optional[np.ndarray] = None  # frame id of last change per tile
+        self._scratch: Optional[np.ndarray] = None
+        self._previous_hash: Optional[int] = None
+        self.first_frame_id: Optional[int] = None
+        self.last_frame_id: Optional[int] = None
+        # Shifted block found in the last update, relative to the frame before it
+        self.move: Optional[Tuple[int, int, int, int, int, int]] = None
+        self.move_mask: Optional[np.ndarray] = None
+        self.move_base_id: Optional[int] = None
+
+    def reset(self) -> None:
+        """Forget all history, forcing the next frame to be a keyframe"""
+        self._previous = None
+        self._versions = None
+        self._scratch = None
+        self._previous_hash = None
+        self.first_frame_id = None
+        self.last_frame_id = None
+        self.move = None
+        self.move_mask = None
+        self.move_base_id = None
+
+    @property
+    def versions(self) -> Optional[np.ndarray]:
+        """Frame id of the last change of every tile"""
+        return self._versions
+
+    @property
+    def grid(self) -> Tuple[int, int]:
+        """Number of tile rows and columns"""
+        return self._versions.shape if self._versions is not None else (0, 0)
+
+    def _grid_for(self, pixels: np.ndarray) -> Tuple[int, int]:
+        height, width = pixels.shape
+        return (-(-height // self.tile_size), -(-width // self.tile_size))
+
+    def update(self, frame: CapturedFrame) -> np.ndarray:
+        """Compare a new frame against the previous one and return the changed tile mask"""
+        pixels = frame_pixels(frame)
+        rows, cols = self._grid_for(pixels)
+        # CRC32 of the raw buffer is much cheaper than a pixel diff and catches idle screens
+        frame.content_hash = zlib.crc32(frame.raw)
+        self.move = None
+        self.move_mask = None
+        self.move_base_id = self.last_frame_id
+
+        if self._previous is None or self._previous.shape != pixels.shape:
+            # First frame or geometry change: everything is new
+            self._versions = np.full((rows, cols), frame.frame_id, dtype=np.int64)
+            self._scratch = np.zeros((rows * self.tile_size, cols * self.tile_size), dtype=bool)
+            self.first_frame_id = frame.frame_id
+            changed = np.ones((rows, cols), dtype=bool)
+        elif frame.content_hash == self._previous_hash:
+            changed = np.zeros((rows, cols), dtype=bool)
+        else:
+            height, width = pixels.shape
+            np.not_equal(pixels, self._previous, out=self._scratch[:height, :width])
+            changed = self._tile_mask()
+            self._versions[changed] = frame.frame_id
+            if changed.sum() >= MIN_MOVE_TILES:
+                self._detect_move(pixels, changed)
+
+        self._previous = pixels
+        self._previous_hash = frame.content_hash
+        self.last_frame_id = frame.frame_id
+        return changed
+
+    def _tile_mask(self) -> np.ndarray:
+        """Reduce the per-pixel scratch diff to a per-tile mask"""
+        rows, cols = self._versions.shape
+        return self._scratch.reshape(rows, self.tile_size, cols, self.tile_size).any(axis=(1, 3))
+
+    def _detect_move(self, pixels: np.ndarray, changed: np.ndarray) -> None:
+        """Look for a scrolled or dragged block within the changed tiles"""
+        height, width = pixels.shape
+        rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+        x0, y0 = int(cols[0]) * self.tile_size, int(rows[0]) * self.tile_size
+        x1 = min((int(cols[-1]) + 1) * self.tile_size, width)
+        y1 = min((int(rows[-1]) + 1) * self.tile_size, height)
+        move = find_move(pixels, self._previous, (x0, y0, x1 - x0, y1 - y0))
+        if move is None:
+            return
+        # With the block copied only the newly exposed pixels still differ
+        _, _, x, y, w, h = move
+        self._scratch[y:y + h, x:x + w] = False
+        self.move = move
+        self.move_mask = self._tile_mask()
+
+    def moved_since(self, frame_id: Optional[int]) -> Optional[Tuple[tuple, np.ndarray]]:
+        """Move and remaining changed tiles for a controller holding the previous frame"""
+        if self.move is None or frame_id is None or frame_id != self.move_base_id:
+            return None
+        return self.move, self.move_mask
+
+    def changed_since(self, frame_id: Optional[int]) -> Optional[np.ndarray]:
+        """Tiles changed after the given frame, or None if a keyframe is required"""
+        if frame_id is None or self.first_frame_id is None or frame_id < self.first_frame_id:
+            return None
+        return self._versions > frame_id
@@ -0,0 +1,275 @@
+import logging
+from typing import List, Dict, Any, Tuple, Optional, NamedTuple
+
+import numpy as np
+import eventlet
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from PIL import Image
+
+from screen_capture import CapturedFrame
+from frame_diff import TILE_SIZE, frame_bgra, frame_pixels
+from image_codecs import encode_image, encode_pixels, get_codec
+from tile_cache import TileStore
+
+logger = logging.getLogger(__name__)
+
+# Screen capture configuration
+QUALITY_SETTINGS = {
+    1: {'quality': 10, 'resize': 0.25},  # Low quality
+    2: {'quality': 30, 'resize': 0.5},   # Medium quality
+    3: {'quality': 50, 'resize': 0.75},  # High quality
+    4: {'quality': 70, 'resize': 1.0}    # Best quality
+}
+
+# Tiles with at most this many colors (text, flat UI) are sent losslessly as a palette image
+PALETTE_MAX_COLORS = 256
+
+# Encodes with more rects than this are split across the worker threads
+PARALLEL_MIN_RECTS = 32
+
+
+class EncodeParams(NamedTuple):
+    """Settings that determine the encoded output of a frame"""
+    quality: int  # lossy codec quality
+    scale: float  # output size relative to the capture
+    codec: str = 'jpeg'  # codec for photographic tiles
+    lossless_codec: str = 'png'  # codec for palette tiles
+
+
+def quality_params(quality_level: int = 4) -> EncodeParams:
+    """Encode settings for a QUALITY_SETTINGS level"""
+    settings = QUALITY_SETTINGS.get(quality_level, QUALITY_SETTINGS[4])
+    return EncodeParams(settings['quality'], settings['resize'])
+
+
+def frame_to_image(frame: CapturedFrame) -> Image.Image:
+    """Wrap the raw BGRA capture buffer as an RGB image"""
+    return Image.frombuffer('RGB', frame.size, frame.raw, 'raw', 'BGRX', 0, 1)
+
+
+def scaled_size(frame: CapturedFrame, scale: float = 1.0) -> Tuple[int, int]:
+    """Output size of a frame at the given scale"""
+    return (max(1, round(frame.width * scale)), max(1, round(frame.height * scale)))
+
+
+def output_rect(frame: CapturedFrame, rect: Tuple[int, int, int, int],
+                scale: float) -> Tuple[int, int, int, int]:
+    """Map a source rectangle onto the output grid as (x0, y0, x1, y1) so tiles tessellate exactly"""
+    out_width, out_height = scaled_size(frame, scale)
+    scale_x = out_width / frame.width
+    scale_y = out_height / frame.height
+    x, y, w, h = rect
+    out_x1 = out_width if x + w >= frame.width else int((x + w) * scale_x)
+    out_y1 = out_height if y + h >= frame.height else int((y + h) * scale_y)
+    return int(x * scale_x), int(y * scale_y), out_x1, out_y1
+
+
+def has_output(frame: CapturedFrame, rect: Tuple[int, int, int, int], scale: float) -> bool:
+    """Check whether a source rectangle covers any output pixels at the given scale"""
+    out_x0, out_y0, out_x1, out_y1 = output_rect(frame, rect, scale)
+    return out_x1 > out_x0 and out_y1 > out_y0
+
+
+def palette_image(pixels: np.ndarray) -> Optional[Image.Image]:
+    """Convert BGRX pixels to an exact palette image, or None if they have too many colors"""
+    colors, indices = np.unique(pixels, return_inverse=True)
+    if len(colors) > PALETTE_MAX_COLORS:
+        return None
+    image = Image.fromarray(indices.reshape(pixels.shape).astype(np.uint8), 'P')
+    palette = np.stack(((colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF), axis=1)
+    image.putpalette(palette.astype(np.uint8).tobytes())
+    return image
+
+
+def palette_tiles(frame: CapturedFrame, rects: List[Tuple[int, int, int, int]]) -> Dict[tuple, Image.Image]:
+    """Palette images of the regions with few enough colors to be sent losslessly"""
+    pixels = frame_pixels(frame)
+    # Screen out photographic regions together: one sort of every other pixel per region,
+    # batched by sample shape, is far cheaper than a full unique per region
+    by_shape: Dict[tuple, List[tuple]] = {}
+    for x, y, w, h in rects:
+        by_shape.setdefault(((h + 1) // 2, (w + 1) // 2), []).append((x, y, w, h))
+    palettes = {}
+    for shape_rects in by_shape.values():
+        samples = np.sort(np.stack([pixels[y:y + h:2, x:x + w:2].ravel() for x, y, w, h in shape_rects]), axis=1)
+        colors = (samples[:, 1:] != samples[:, :-1]).sum(axis=1) + 1
+        for (x, y, w, h), count in zip(shape_rects, colors):
+            if count > PALETTE_MAX_COLORS:
+                continue
+            image = palette_image(pixels[y:y + h, x:x + w])
+            if image is not None:
+                palettes[(x, y, w, h)] = image
+    return palettes
+
+
+def encode_rects(frame: CapturedFrame, rects: List[Tuple[int, int, int, int]], params: EncodeParams,
+                 palettes: Optional[Dict[tuple, Image.Image]] = None) -> List[Optional[Dict[str, Any]]]:
+    """Resize and encode regions of a raw frame, one result per rect in output coordinates"""
+    # palettes: regions already classified by palette_tiles; any other rect is photographic.
+    # A rect that fails to encode gives None, like one with no output pixels
+    out_width, out_height = scaled_size(frame, params.scale)
+    scale_x = out_width / frame.width
+    scale_y = out_height / frame.height
+
+    img = None  # decoded lazily: the native path encodes from the raw buffer
+    pixels = frame_pixels(frame)
+    bgra = frame_bgra(frame)  # byte view for codecs that encode raw pixels
+    results: List[Optional[Dict[str, Any]]] = []
+    for x, y, w, h in rects:
+        out_x0, out_y0, out_x1, out_y1 = output_rect(frame, (x, y, w, h), params.scale)
+        if out_x1 <= out_x0 or out_y1 <= out_y0:
+            results.append(None)
+            continue
+
+        try:
+            codec = params.codec
+            data = None
+            region = None
+            if out_width == frame.width and out_height == frame.height:
+                # Text and flat UI stay sharp losslessly; scaled tiles are smoothed anyway
+                tile_pixels = pixels[y:y + h, x:x + w]
+                if palettes is not None:
+                    region = palettes.get((x, y, w, h))
+                elif w * h <= TILE_SIZE * TILE_SIZE:
+                    # Only tile-sized blocks are classified; larger ones are mixed content too often
+                    region = palette_image(tile_pixels)
+                if region is not None:
+                    codec = params.lossless_codec
+                else:
+                    data = encode_pixels(codec, bgra[y:y + h, x:x + w], params.quality)
+                    if data is None:
+                        if img is None:
+                            img = frame_to_image(frame)
+                        region = img.crop((x, y, x + w, y + h))
+            else:
+                if img is None:
+                    img = frame_to_image(frame)
+                box = (out_x0 / scale_x, out_y0 / scale_y, out_x1 / scale_x, out_y1 / scale_y)
+                region = img.resize((out_x1 - out_x0, out_y1 - out_y0), Image.Resampling.LANCZOS, box=box)
+
+            results.append({
+                'x': out_x0,
+                'y': out_y0,
+                'w': out_x1 - out_x0,
+                'h': out_y1 - out_y0,
+                'format': get_codec(codec).format,
+                'data': data if data is not None else encode_image(codec, region, params.quality)
+            })
+        except Exception as e:
+            logger.error(f"Error encoding tile {(x, y, w, h)}: {e}")
+            results.append(None)
+    return results
+
+
+class EncodeCache:
+    """Encoded tiles of the newest frame of each capture area, shared by all controllers"""
+
+    def __init__(self):
+        self._newest: Dict[tuple, int] = {}  # capture area -> newest frame id
+        self._entries: Dict[int, Dict[tuple, Optional[Dict[str, Any]]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame: CapturedFrame, params: EncodeParams, rect: tuple) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Look up an encoded tile, returning (found, tile)"""
+        entries = self._entries.get(frame.frame_id, {})
+        if (params, rect) in entries:
+            self.hits += 1
+            return True, entries[(params, rect)]
+        self.misses += 1
+        return False, None
+
+    def put(self, frame: CapturedFrame, params: EncodeParams, rect: tuple, tile: Optional[Dict[str, Any]]) -> None:
+        """Store an encoded tile, evicting the older frame of the same capture area"""
+        newest = self._newest.get(frame.area)
+        if newest is not None and frame.frame_id < newest:
+            return  # late encode of a superseded frame
+        if newest != frame.frame_id:
+            self._entries.pop(newest, None)
+            self._newest[frame.area] = frame.frame_id
+        self._entries.setdefault(frame.frame_id, {})[(params, rect)] = tile
+
+    def retain(self, areas: set) -> None:
+        """Drop the tiles of capture areas no stream captures anymore, e.g. abandoned regions"""
+        for area in [area for area in self._newest if area not in areas]:
+            self._entries.pop(self._newest.pop(area), None)
+
+    def clear(self) -> None:
+        """Drop all encoded tiles, e.g. while capture is suspended"""
+        self._newest.clear()
+        self._entries.clear()
+
+
+class EncoderPool:
+    """Bounded pool of native threads running encodes off the eventlet hub"""
+
+    def __init__(self, size: int = 4):
+        self.size = max(1, size)
+        self._slots = Semaphore(self.size)
+        self.cache = EncodeCache()
+        self.store = TileStore()
+        # PIL releases the GIL while resizing and encoding, so threads scale
+        tpool.set_num_threads(self.size)
+        logger.info(f"Encoder pool using {self.size} worker thread(s)")
+
+    def classify(self, frame: CapturedFrame, rects: List[Tuple[int, int, int, int]]) -> Dict[tuple, Image.Image]:
+        """Find the palette regions among rects on the worker threads"""
+        palettes = {}
+        for chunk in self._map_chunks(palette_tiles, frame, rects):
+            palettes.update(chunk)
+        return palettes
+
+    def encode_tiles(self, frame: CapturedFrame, rects: List[Tuple[int, int, int, int]],
+                     params: EncodeParams, keys: Optional[List[bytes]] = None,
+                     palettes: Optional[Dict[tuple, Image.Image]] = None) -> Optional[List[Dict[str, Any]]]:
+        """Encode tiles on a worker thread, reusing this frame's tiles and, by content key, earlier ones"""
+        # None if any rect failed: a partial update would leave the controller with stale areas
+        # Tiles of keyed requests carry their 'key' so controllers can cache them
+        results: Dict[tuple, Optional[Dict[str, Any]]] = {}
+        missing = []
+        for index, rect in enumerate(rects):
+            key = keys[index] if keys else None
+            found, tile = self.cache.get(frame, params, rect)
+            stored = self.store.get(key) if key and not found else None
+            if found:
+                results[rect] = dict(tile, key=key) if key and tile else tile
+            elif stored:
+                out_x0, out_y0, out_x1, out_y1 = output_rect(frame, rect, params.scale)
+                results[rect] = {'x': out_x0, 'y': out_y0, 'w': out_x1 - out_x0, 'h': out_y1 - out_y0,
+                                 'format': stored[0], 'data': stored[1], 'key': key}
+            else:
+                missing.append((rect, key))
+
+        if missing:
+            missing_rects = [rect for rect, _ in missing]
+            encoded = [tile for chunk in self._map_chunks(encode_rects, frame, missing_rects, params, palettes)
+                       for tile in chunk]
+            for (rect, key), tile in zip(missing, encoded):
+                if tile is not None:
+                    self.cache.put(frame, params, rect, tile)
+                    if key:
+                        self.store.put(key, tile)
+                        tile = dict(tile, key=key)
+                results[rect] = tile
+
+        failed = [rect for rect in rects if results[rect] is None and has_output(frame, rect, params.scale)]
+        if failed:
+            logger.error(f"Failed to encode {len(failed)} of {len(rects)} tiles of frame {frame.frame_id}")
+            return None
+        return [results[rect] for rect in rects if results[rect]]
+
+    def execute(self, fn, *args):
+        """Run another encode job on a worker thread, sharing the pool's slots"""
+        with self._slots:
+            return tpool.execute(fn, *args)
+
+    def _map_chunks(self, fn, frame: CapturedFrame, rects: List[Tuple[int, int, int, int]], *args) -> list:
+        """Run fn(frame, rects, *args), split over the workers when there are many rects"""
+        chunks = [rects]
+        if len(rects) > PARALLEL_MIN_RECTS:
+            # Keyframes are hundreds of small tiles; spread them over the workers
+            size = -(-len(rects) // self.size)
+            chunks = [rects[i:i + size] for i in range(0, len(rects), size)]
+        pool = eventlet.GreenPool(len(chunks))
+        return list(pool.imap(lambda chunk: self.execute(fn, frame, chunk, *args), chunks))
@@ -0,0 +1,1047 @@
+import time
+import base64
+import logging
+import traceback
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import eventlet
+import numpy as np
+
+from screen_capture import CaptureEngine, CapturedFrame
+from cursor_tracker import CursorTracker
+from image_codecs import FALLBACK_CODEC, FALLBACK_LOSSLESS_CODEC, negotiate
+from adaptive_quality import AUTO_QUALITY, AdaptiveQuality
+from frame_rate import DEFAULT_MIN_FPS, FrameRateGovernor
+from frame_encoder import EncoderPool, EncodeParams, quality_params, scaled_size
+from frame_diff import TileTracker, tile_rects
+from tile_cache import TileCache, MAX_TILE_CACHE_SIZE, tile_keys
+from video_encoder import (VideoEncoder, DEFAULT_VIDEO_BITRATE, MIN_VIDEO_BITRATE, MAX_VIDEO_BITRATE,
+                           DEFAULT_KEYFRAME_INTERVAL, available_video_codecs)
+
+logger = logging.getLogger(__name__)
+
+# Above this fraction of dirty tiles a single full-frame image is cheaper than tiles
+FULL_FRAME_THRESHOLD = 0.5
+
+# Push streaming defaults
+DEFAULT_STREAM_FPS = 30
+DEFAULT_STREAM_CREDITS = 2
+MAX_STREAM_CREDITS = 8
+ACK_TIMEOUT = 5.0  # seconds before an unacknowledged frame no longer holds a credit
+
+# Progressive refinement: tiles static for a few captures are re-sent at high quality
+REFINE_AFTER_FRAMES = 5
+REFINE_QUALITY = 90
+REFINE_TILES_PER_FRAME = 32  # budget so refinement never crowds out live updates
+
+# Bounds for viewport sizes reported by controllers
+MAX_VIEWPORT_SIZE = 8192  # device pixels
+MAX_DEVICE_PIXEL_RATIO = 4.0
+
+# Capture and encoding stop once no visible controller has wanted frames for this long
+SUSPEND_AFTER = 0.5  # seconds
+
+# Video codecs in order of preference when a controller can decode several
+DEFAULT_VIDEO_PREFERENCE = ['h264', 'vp9', 'vp8']
+
+
+class ViewerState:
+    """Delivery state of one controller connection"""
+
+    def __init__(self, controller_sid: str, session_id: str):
+        self.controller_sid = controller_sid
+        self.session_id = session_id
+        self.last_frame_id: Optional[int] = None  # last frame the controller holds
+        self.last_hash: Optional[int] = None  # content hash of that frame
+        self.params: Optional[tuple] = None  # stream and encode settings of that frame
+        self.keyframe_requested = True
+        self.binary = False  # controller accepts binary attachments
+        self.visible = True  # controller tab is in the foreground
+        self.monitor: Optional[int] = None  # monitor index, None for the engine default
+        self.region: Optional[tuple] = None  # normalized region of interest
+        self.viewport: Optional[Tuple[int, int]] = None  # canvas size in device pixels
+        self.codec = FALLBACK_CODEC  # negotiated codecs
+        self.lossless_codec = FALLBACK_LOSSLESS_CODEC
+        self.refine = True  # progressive refinement of static tiles
+        self.adaptive: Optional[AdaptiveQuality] = None  # set while the session quality is auto
+        self.last_sent_at: Optional[float] = None  # emit time of the frame a poll answers
+        self.refined_at: Optional[np.ndarray] = None  # frame id each tile was last refined at
+
+        # Video mode: inter-frame encoded stream instead of tiles
+        self.video: Optional[dict] = None  # codec, bitrate and keyframe_interval while enabled
+        self.video_encoder: Optional[VideoEncoder] = None
+
+        # Content-addressed tile cache: mirror of the tiles the controller keeps
+        self.tile_cache: Optional[TileCache] = None
+
+        # Poll mode: one frame per request_frame
+        self.frame_requested = False
+
+        # Push mode: server-paced frames limited by credits
+        self.streaming = False
+        self.fps = DEFAULT_STREAM_FPS
+        self.window = DEFAULT_STREAM_CREDITS
+        self.in_flight: Dict[int, float] = {}  # frame id -> send time
+        self.next_due = 0.0
+        self.last_advanced = 0.0
+        self.rate_limit: Optional[int] = None  # frame rate the motion governor allows
+
+        # Latest-frame-wins slot for frames the controller cannot take yet
+        self.pending_frame: Optional[CapturedFrame] = None
+        self.sending = False
+        self.encode_started: Optional[float] = None  # when encoding of the frame in delivery began
+
+        # Cursor channel: last position sent and shapes the controller has cached
+        self.cursor_sent: Optional[tuple] = None
+        self.cursor_shapes = set()
+        self.frames_sent = 0
+        self.frames_dropped_stale = 0
+
+    @property
+    def credits(self) -> int:
+        """Frames the controller is still willing to receive"""
+        return self.window - len(self.in_flight)
+
+    @property
+    def active(self) -> bool:
+        """Check whether the controller is visible and waiting for frames"""
+        return self.visible and (self.frame_requested or self.streaming)
+
+    @property
+    def stream_key(self) -> tuple:
+        """Key of the capture stream this controller watches"""
+        return (self.monitor, self.region)
+
+    def needs_keyframe(self, params: tuple) -> bool:
+        """Check whether the controller must receive a full frame"""
+        return self.keyframe_requested or self.last_frame_id is None or params != self.params
+
+    def is_due(self, now: float, tick: float) -> bool:
+        """Check whether the controller should get a frame this tick"""
+        if not self.visible:
+            return False
+        if self.frame_requested:
+            # Polls are answered at the governed rate too, keyframes at once
+            return self.keyframe_requested or now + tick / 2 >= self.next_due
+        if not self.streaming:
+            return False
+        # Frames that were never acknowledged stop holding credits eventually
+        for frame_id, sent in list(self.in_flight.items()):
+            if now - sent > ACK_TIMEOUT:
+                del self.in_flight[frame_id]
+                if self.adaptive:
+                    self.adaptive.record_timeout()
+        return now + tick / 2 >= self.next_due
+
+    def can_send(self) -> bool:
+        """Check whether a frame may be emitted right now"""
+        if self.sending:
+            return False
+        return self.frame_requested or (self.streaming and self.credits > 0)
+
+    def hold(self, frame: CapturedFrame, now: float) -> bool:
+        """Park a frame in the slot, returning True if an older one was dropped"""
+        dropped = self.pending_frame is not None
+        self.pending_frame = frame
+        if dropped:
+            self.frames_dropped_stale += 1
+        if self.streaming:
+            self._advance(now)
+        return dropped
+
+    def mark_sent(self, frame: CapturedFrame, now: float) -> None:
+        """Record a delivered frame"""
+        self._hold_content(frame)
+        self.keyframe_requested = False
+        self.frames_sent += 1
+        if self.frame_requested:
+            self.frame_requested = False
+        elif self.streaming:
+            self.in_flight[frame.frame_id] = now
+        self._advance(now)
+
+    def mark_unchanged(self, frame: CapturedFrame, now: float) -> None:
+        """Record a frame identical to what the controller already shows"""
+        self._hold_content(frame)
+        if self.frame_requested:
+            self.frame_requested = False
+        self._advance(now)
+
+    def hold_keyframe(self, frame_id: int, content_hash: Optional[int], params: tuple) -> None:
+        """Record a cached keyframe pushed to the controller as the frame it holds"""
+        self.last_frame_id = frame_id
+        self.last_hash = content_hash
+        self.params = params
+        self.keyframe_requested = False
+        self.frames_sent += 1
+
+    def _hold_content(self, frame: CapturedFrame) -> None:
+        """Remember the frame the controller now holds"""
+        self.last_frame_id = frame.frame_id
+        self.last_hash = frame.content_hash
+        if self.pending_frame is not None and self.pending_frame.frame_id <= frame.frame_id:
+            self.pending_frame = None
+
+    @property
+    def effective_fps(self) -> int:
+        """Requested stream rate, lowered by adaptive quality and the motion governor"""
+        fps = self.fps
+        if self.adaptive:
+            fps = min(fps, self.adaptive.current.fps)
+        if self.rate_limit:
+            fps = min(fps, self.rate_limit)
+        return fps
+
+    def set_rate_limit(self, fps: int) -> None:
+        """Apply the motion governor's rate, reacting at once when motion starts"""
+        if fps == self.rate_limit:
+            return
+        raised = self.rate_limit is not None and fps > self.rate_limit
+        self.rate_limit = fps
+        if raised:
+            self.next_due = min(self.next_due, self.last_advanced + 1.0 / self.effective_fps)
+
+    def _advance(self, now: float) -> None:
+        """Schedule the next frame"""
+        self.last_advanced = now
+        interval = 1.0 / self.effective_fps
+        # Keep the cadence but never try to catch up with a burst
+        self.next_due = max(self.next_due + interval, now - interval / 2)
+
+
+class CaptureStream:
+    """One capture area of the host with its own change tracking"""
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.monitor: Optional[int] = key[0]
+        self.region: Optional[tuple] = key[1]
+        self.tracker = TileTracker()
+        self.area: Optional[tuple] = None  # (left, top, width, height) of the last capture
+        self.recent_frame_ids = deque(maxlen=REFINE_AFTER_FRAMES + 1)
+        self.governor = FrameRateGovernor()
+
+    @property
+    def static_frame_id(self) -> Optional[int]:
+        """Tiles unchanged since this frame have been static for REFINE_AFTER_FRAMES captures"""
+        if len(self.recent_frame_ids) < self.recent_frame_ids.maxlen:
+            return None
+        return self.recent_frame_ids[0]
+
+
+class FrameProducer:
+    """Capture the host screen once per tick and fan frames out to controllers"""
+
+    def __init__(self, socketio, session_manager, capture_engine: CaptureEngine,
+                 encoder_pool: EncoderPool, cursor_tracker: Optional[CursorTracker] = None,
+                 codec_preference: Optional[List[str]] = None, fps: int = 30):
+        self.socketio = socketio
+        self.session_manager = session_manager
+        self.capture_engine = capture_engine
+        self.encoder_pool = encoder_pool
+        self.cursor_tracker = cursor_tracker
+        self.codec_preference = codec_preference
+        self.max_fps = fps
+        self.interval = 1.0 / fps
+        self._viewers: Dict[str, ViewerState] = {}
+        self._streams: Dict[tuple, CaptureStream] = {}
+        self._task = None
+        self._running = False
+        self._generation = 0  # tells a superseded loop to exit
+
+    def _get_viewer(self, session_id: str, controller_sid: str) -> Optional[ViewerState]:
+        """Get or create the delivery state of a session controller"""
+        if controller_sid not in self.session_manager.get_session_controllers(session_id):
+            logger.warning(f"Client {controller_sid} is not a controller of session {session_id}")
+            return None
+
+        viewer = self._viewers.get(controller_sid)
+        if viewer is None or viewer.session_id != session_id:
+            viewer = ViewerState(controller_sid, session_id)
+            self._viewers[controller_sid] = viewer
+        return viewer
+
+    def request_frame(self, session_id: str, controller_sid: str, keyframe: bool = False,
+                      binary: bool = False) -> bool:
+        """Queue a controller for the next produced frame"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        if keyframe:
+            viewer.keyframe_requested = True
+        if viewer.adaptive and viewer.last_sent_at is not None:
+            # A poll right after a frame arrives measures the round trip
+            viewer.adaptive.record_ack(time.time() - viewer.last_sent_at)
+        viewer.last_sent_at = None
+        viewer.binary = binary
+        viewer.frame_requested = True
+        if viewer.visible:
+            self._ensure_running()
+        return True
+
+    def start_stream(self, session_id: str, controller_sid: str, fps: int = DEFAULT_STREAM_FPS,
+                     credits: int = DEFAULT_STREAM_CREDITS, binary: bool = False) -> bool:
+        """Push frames to a controller at a target rate, limited by its credits"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        viewer.streaming = True
+        viewer.fps = max(1, min(int(fps), self.max_fps))
+        viewer.window = max(1, min(int(credits), MAX_STREAM_CREDITS))
+        viewer.binary = binary
+        viewer.in_flight.clear()
+        viewer.next_due = 0.0
+        logger.info(f"Streaming to {controller_sid} at {viewer.fps} FPS with {viewer.window} credits")
+        if viewer.visible:
+            self._ensure_running()
+        return True
+
+    def set_refinement(self, session_id: str, controller_sid: str, enabled: bool) -> bool:
+        """Turn progressive refinement of static tiles on or off for a controller"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        viewer.refine = bool(enabled)
+        return True
+
+    def set_region(self, session_id: str, controller_sid: str, region: Optional[dict]) -> bool:
+        """Restrict a controller to a normalized region of the screen, or None for all of it"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        if region:
+            region = tuple(round(min(max(float(region[key]), 0.0), 1.0), 4)
+                           for key in ('x', 'y', 'width', 'height'))
+            if region == (0.0, 0.0, 1.0, 1.0):
+                region = None
+        else:
+            region = None
+        if region == viewer.region:
+            return True
+        viewer.region = region
+        # A frame from the previous area is of no use anymore
+        viewer.pending_frame = None
+        logger.info(f"Region of interest for {controller_sid}: {viewer.region}")
+        return True
+
+    def select_monitor(self, session_id: str, controller_sid: str, monitor_index: Optional[int]) -> bool:
+        """Switch a controller to another monitor, or None for the default one"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        if monitor_index is not None:
+            monitor_index = int(monitor_index)
+            if not any(m['index'] == monitor_index for m in self.capture_engine.monitors()):
+                logger.error(f"Invalid monitor {monitor_index} requested by {controller_sid}")
+                return False
+        if monitor_index == viewer.monitor:
+            return True
+        viewer.monitor = monitor_index
+        # Zoom regions are relative to the monitor they were picked on
+        viewer.region = None
+        viewer.pending_frame = None
+        logger.info(f"Monitor for {controller_sid}: {monitor_index}")
+        return True
+
+    def set_codecs(self, session_id: str, controller_sid: str,
+                   supported: Optional[List[str]]) -> Optional[dict]:
+        """Negotiate tile codecs with the formats a controller can decode"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return None
+        viewer.codec = negotiate(supported, self.codec_preference)
+        viewer.lossless_codec = negotiate(supported, self.codec_preference, lossless=True)
+        logger.info(f"Codecs for {controller_sid}: {viewer.codec}, {viewer.lossless_codec}")
+        return {'codec': viewer.codec, 'lossless_codec': viewer.lossless_codec}
+
+    def set_tile_cache(self, session_id: str, controller_sid: str, size: int) -> Optional[dict]:
+        """Start an empty tile cache of the size a controller offers, or turn it off with 0"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return None
+        size = max(0, min(int(size), MAX_TILE_CACHE_SIZE))
+        if viewer.tile_cache is not None:
+            # Tiles drawn from the old cache may be gone on the controller
+            viewer.keyframe_requested = True
+        viewer.tile_cache = TileCache(size) if size else None
+        logger.info(f"Tile cache for {controller_sid}: {size} tiles")
+        return {'size': size}
+
+    def set_viewport(self, session_id: str, controller_sid: str, width: float, height: float,
+                     dpr: float = 1.0) -> bool:
+        """Record the controller's display size so frames are never larger than it can show"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        dpr = min(max(float(dpr), 0.5), MAX_DEVICE_PIXEL_RATIO)
+        width, height = int(float(width) * dpr), int(float(height) * dpr)
+        if width <= 0 or height <= 0:
+            viewer.viewport = None
+        else:
+            viewer.viewport = (min(width, MAX_VIEWPORT_SIZE), min(height, MAX_VIEWPORT_SIZE))
+        logger.info(f"Viewport for {controller_sid}: {viewer.viewport}")
+        return True
+
+    def set_video_mode(self, session_id: str, controller_sid: str, enabled: bool,
+                       codecs: Optional[List[str]] = None, bitrate: Optional[int] = None,
+                       keyframe_interval: Optional[int] = None) -> Optional[dict]:
+        """Switch a controller between tiles and a video stream in a codec it can decode"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return None
+        viewer.keyframe_requested = True
+        viewer.pending_frame = None
+        codec = None
+        if enabled:
+            available = available_video_codecs()
+            codec = next((name for name in DEFAULT_VIDEO_PREFERENCE
+                          if name in available and name in (codecs or [])), None)
+        if codec is None:
+            viewer.video = None
+            if enabled:
+                logger.info(f"No common video codec with {controller_sid}, staying with tiles")
+            return {'enabled': False}
+
+        viewer.video = {
+            'codec': codec,
+            'bitrate': max(MIN_VIDEO_BITRATE, min(int(bitrate or DEFAULT_VIDEO_BITRATE), MAX_VIDEO_BITRATE)),
+            'keyframe_interval': max(1, int(keyframe_interval or DEFAULT_KEYFRAME_INTERVAL))
+        }
+        logger.info(f"Video mode for {controller_sid}: {viewer.video}")
+        return dict(viewer.video, enabled=True)
+
+    def set_frame_rate(self, session_id: str, controller_sid: str, min_fps: Optional[int] = None,
+                       max_fps: Optional[int] = None) -> Optional[dict]:
+        """Set the session's keepalive and full-motion frame rates"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        session = self.session_manager.get_session(session_id)
+        if viewer is None or session is None:
+            return None
+        if max_fps is None:
+            max_fps = getattr(session, 'max_fps', self.max_fps)
+        if min_fps is None:
+            min_fps = getattr(session, 'min_fps', DEFAULT_MIN_FPS)
+        session.max_fps = max(1, min(int(max_fps), self.max_fps))
+        session.min_fps = max(1, min(int(min_fps), session.max_fps))
+        logger.info(f"Frame rate for session {session_id}: {session.min_fps}-{session.max_fps} FPS")
+        return {'min_fps': session.min_fps, 'max_fps': session.max_fps}
+
+    def notify_input(self, session_id: str) -> None:
+        """Raise the frame rate of a session's streams ahead of the changes input will cause"""
+        now = time.time()
+        for viewer in list(self._viewers.values()):
+            stream = self._streams.get(viewer.stream_key)
+            if viewer.session_id == session_id and stream:
+                stream.governor.wake(now)
+
+    def set_visibility(self, session_id: str, controller_sid: str, visible: bool) -> bool:
+        """Pause a controller while its tab is hidden and resume it when shown"""
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None:
+            return False
+        viewer.visible = bool(visible)
+        if viewer.visible:
+            logger.info(f"Controller {controller_sid} visible, resuming frames")
+            self._ensure_running()
+            return True
+
+        logger.info(f"Controller {controller_sid} hidden, pausing frames")
+        viewer.pending_frame = None
+        viewer.in_flight.clear()
+        if viewer.video_encoder and not viewer.sending:
+            viewer.video_encoder.close()
+            viewer.video_encoder = None
+        return True
+
+    def send_cached_keyframe(self, session_id: str, controller_sid: str, binary: bool = False,
+                             codecs: Optional[List[str]] = None) -> bool:
+        """Push the session's last keyframe to a joining controller so it shows the screen at once"""
+        session = self.session_manager.get_session(session_id)
+        cached = getattr(session, 'last_keyframe', None) if session else None
+        if cached is None:
+            return False
+        viewer = self._get_viewer(session_id, controller_sid)
+        if viewer is None or viewer.stream_key != cached['stream_key']:
+            return False
+        supported = set(codecs or []) | {FALLBACK_CODEC, FALLBACK_LOSSLESS_CODEC}
+        params = cached['params']
+        if params.codec not in supported or params.lossless_codec not in supported:
+            return False
+
+        viewer.binary = binary
+        payload = cached['payload'] if binary else self._to_base64(cached['payload'])
+        self.socketio.emit('frame', payload, to=controller_sid)
+        # Later updates are deltas against this frame while its stream is still tracked
+        viewer.hold_keyframe(payload['frame_id'], cached['content_hash'], (cached['stream_key'], params))
+        self._count(viewer, 'frames_sent')
+        logger.info(f"Sent cached keyframe {payload['frame_id']} to {controller_sid}")
+        return True
+
+    def stop_stream(self, controller_sid: str) -> None:
+        """Return a controller to poll mode"""
+        viewer = self._viewers.get(controller_sid)
+        if viewer:
+            viewer.streaming = False
+            viewer.in_flight.clear()
+            viewer.pending_frame = None
+
+    def ack_frame(self, controller_sid: str, frame_id: int) -> None:
+        """Give back the credit held by a delivered frame"""
+        viewer = self._viewers.get(controller_sid)
+        if not viewer:
+            return
+        sent = viewer.in_flight.pop(frame_id, None)
+        if sent is not None and viewer.adaptive:
+            viewer.adaptive.record_ack(time.time() - sent)
+
+        # Deliver the parked frame right away instead of waiting for the next capture
+        if viewer.pending_frame is not None and viewer.can_send():
+            session = self.session_manager.get_session(viewer.session_id)
+            stream = self._streams.get(viewer.stream_key)
+            if session and stream:
+                frame, viewer.pending_frame = viewer.pending_frame, None
+                viewer.sending = True
+                self.socketio.start_background_task(
+                    self._deliver, stream, frame, [(viewer, getattr(session, 'quality', 4))])
+
+    def remove_controller(self, controller_sid: str) -> None:
+        """Forget all delivery state of a controller"""
+        viewer = self._viewers.pop(controller_sid, None)
+        if viewer and viewer.video_encoder and not viewer.sending:
+            viewer.video_encoder.close()
+
+    def stop(self) -> None:
+        """Stop the producer loop"""
+        self._running = False
+        self._task = None
+
+    def _ensure_running(self) -> None:
+        """Start the producer loop if it is not running yet"""
+        if self._task is None:
+            self._running = True
+            self._generation += 1
+            self._task = self.socketio.start_background_task(self._run, self._generation)
+
+    def _suspend(self) -> None:
+        """Stop the loop and release capture resources until a controller wants frames again"""
+        self._running = False
+        self._task = None
+        self._streams.clear()
+        self.encoder_pool.cache.clear()
+        self.capture_engine.stop()
+        logger.info("No visible controllers, capture suspended")
+
+    def _run(self, generation: int) -> None:
+        """Producer loop, one capture per tick at most"""
+        logger.info("Frame producer started")
+        idle_since = None
+        while self._running and generation == self._generation:
+            started = time.time()
+            if any(viewer.active for viewer in self._viewers.values()):
+                idle_since = None
+            elif idle_since is None:
+                idle_since = started
+            elif started - idle_since >= SUSPEND_AFTER:
+                self._suspend()
+                break
+            try:
+                self._tick(started)
+            except Exception as e:
+                logger.error(f"Error producing frame: {e}")
+                traceback.print_exc()
+            try:
+                self._send_cursor()
+            except Exception as e:
+                logger.error(f"Error sending cursor: {e}")
+            elapsed = time.time() - started
+            self.socketio.sleep(max(0.0, self.interval - elapsed))
+        logger.info("Frame producer stopped")
+
+    def _tick(self, now: float) -> None:
+        """Capture each watched area once and deliver to every controller that is due"""
+        due: Dict[tuple, List[Tuple[ViewerState, int]]] = {}
+        for viewer in list(self._viewers.values()):
+            self._adapt(viewer, now)
+            self._govern(viewer, now)
+            if not viewer.is_due(now, self.interval):
+                continue
+            session = self.session_manager.get_session(viewer.session_id)
+            if not session or viewer.controller_sid not in session.controllers:
+                self._viewers.pop(viewer.controller_sid, None)
+                continue
+            due.setdefault(viewer.stream_key, []).append((viewer, getattr(session, 'quality', 4)))
+
+        # Drop streams nobody watches anymore
+        watched = {viewer.stream_key for viewer in self._viewers.values() if viewer.visible}
+        for key in list(self._streams):
+            if key not in watched:
+                del self._streams[key]
+        self.encoder_pool.cache.retain({stream.area for stream in self._streams.values()})
+
+        for key, viewers in due.items():
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = self._streams[key] = CaptureStream(key)
+            self._tick_stream(stream, viewers, now)
+
+    def _tick_stream(self, stream: CaptureStream, viewers: List[Tuple[ViewerState, int]],
+                     now: float) -> None:
+        """Capture one area once and hand the frame to its due controllers"""
+        frame = self.capture_engine.grab(stream.region, stream.monitor)
+        if not frame:
+            return
+        stream.governor.update(stream.tracker.update(frame), now)
+        stream.area = frame.area
+        stream.recent_frame_ids.append(frame.frame_id)
+
+        ready: List[Tuple[ViewerState, int]] = []
+        for viewer, quality in viewers:
+            if viewer.can_send():
+                viewer.sending = True
+                ready.append((viewer, quality))
+            elif viewer.hold(frame, now):
+                # Latest frame wins: the undelivered older frame is stale now
+                self._count(viewer, 'frames_dropped_stale')
+        if ready:
+            self._deliver(stream, frame, ready)
+
+    def _deliver(self, stream: CaptureStream, frame: CapturedFrame,
+                 viewers: List[Tuple[ViewerState, int]]) -> None:
+        """Encode and emit a frame to controllers, sharing encodes where possible"""
+        # Delivery time counts from here: time parked waiting for a credit is network delay
+        started = time.time()
+        for viewer, _ in viewers:
+            viewer.encode_started = started
+        try:
+            self._emit_updates(stream, frame, viewers)
+        except Exception as e:
+            logger.error(f"Error delivering frame: {e}")
+            traceback.print_exc()
+        finally:
+            for viewer, _ in viewers:
+                viewer.sending = False
+
+    def _adapt(self, viewer: ViewerState, now: float) -> None:
+        """Let adaptive quality close its measurement period and report any change"""
+        if not viewer.adaptive:
+            return
+        decision = viewer.adaptive.update(now)
+        if decision:
+            self.socketio.emit('quality_adjusted', decision, to=viewer.controller_sid)
+
+    def _govern(self, viewer: ViewerState, now: float) -> None:
+        """Pace a controller by how much its capture area is changing"""
+        stream = self._streams.get(viewer.stream_key)
+        session = self.session_manager.get_session(viewer.session_id)
+        if stream is None or session is None:
+            return
+        viewer.set_rate_limit(stream.governor.fps(
+            getattr(session, 'min_fps', DEFAULT_MIN_FPS), getattr(session, 'max_fps', self.max_fps), now))
+
+    def _encode_params(self, stream: CaptureStream, frame: CapturedFrame, viewer: ViewerState,
+                       quality: int) -> EncodeParams:
+        """Encode settings for a controller at a quality level"""
+        if quality == AUTO_QUALITY:
+            if viewer.adaptive is None:
+                viewer.adaptive = AdaptiveQuality()
+            step = viewer.adaptive.current
+            params = EncodeParams(step.quality, step.scale)
+        else:
+            viewer.adaptive = None
+            params = quality_params(quality)
+        params = params._replace(codec=viewer.codec, lossless_codec=viewer.lossless_codec)
+        if stream.region:
+            # Regions of interest are sent at native resolution
+            params = params._replace(scale=1.0)
+        if viewer.viewport:
+            # Never encode more pixels than the controller can display
+            fit = min(viewer.viewport[0] / frame.width, viewer.viewport[1] / frame.height)
+            if fit < params.scale:
+                params = params._replace(scale=fit)
+        return params
+
+    def _emit_updates(self, stream: CaptureStream, frame: CapturedFrame,
+                      viewers: List[Tuple[ViewerState, int]]) -> None:
+        """Group controllers by what they need and emit one encode per group"""
+        # Controllers with the same settings holding the same frame share one encode
+        groups: Dict[tuple, List[ViewerState]] = {}
+        for viewer, quality in viewers:
+            params = self._encode_params(stream, frame, viewer, quality)
+            if viewer.video:
+                self._send_video(stream, frame, viewer, quality, params)
+                continue
+            if viewer.video_encoder:
+                viewer.video_encoder.close()
+                viewer.video_encoder = None
+            keyframe = viewer.needs_keyframe((stream.key, params))
+            if not keyframe and viewer.last_hash == frame.content_hash:
+                # Identical content: nothing new to encode, but static tiles may be sharpened
+                refinement = self._refine_tiles(stream, frame, viewer, params)
+                if refinement:
+                    width, height = scaled_size(frame, params.scale)
+                    self._send_frame(viewer, frame, self._payload(
+                        stream, frame, quality, width, height, False, refinement, []))
+                else:
+                    self._send_unchanged(viewer, frame)
+                continue
+            base_frame_id = None if keyframe else viewer.last_frame_id
+            cached = viewer.tile_cache is not None
+            groups.setdefault((quality, params, base_frame_id, cached), []).append(viewer)
+        if not groups:
+            return
+
+        # Encode the groups concurrently on the worker pool
+        pool = eventlet.GreenPool(self.encoder_pool.size)
+        keys = list(groups)
+        payloads = pool.imap(lambda key: self._build_update(stream, frame, *key), keys)
+        for key, payload in zip(keys, payloads):
+            group = groups[key]
+            if payload is None:
+                continue
+            quality, params, base_frame_id, _ = key
+            self._cache_keyframe(stream, frame, params, payload, group)
+            fallback = None
+            for viewer in group:
+                viewer.params = (stream.key, params)
+                if self._covers_frame(payload):
+                    # Everything was just re-sent at the normal quality
+                    viewer.refined_at = None
+                    refinement = []
+                else:
+                    refinement = self._refine_tiles(stream, frame, viewer, params)
+                if refinement:
+                    self._send_frame(viewer, frame, dict(payload, tiles=payload['tiles'] + refinement))
+                    continue
+                if not payload['tiles'] and not payload['copies']:
+                    self._send_unchanged(viewer, frame)
+                    continue
+                if not viewer.binary and not viewer.tile_cache:
+                    fallback = fallback or self._to_base64(payload)
+                self._send_frame(viewer, frame, payload, fallback)
+
+    def _send_frame(self, viewer: ViewerState, frame: CapturedFrame, payload: dict,
+                    fallback: Optional[dict] = None) -> None:
+        """Emit a frame update in the form the controller accepts"""
+        if viewer.tile_cache:
+            payload = self._apply_tile_cache(viewer.tile_cache, payload)
+        now = time.time()
+        if viewer.adaptive:
+            size = sum(len(tile.get('data', b'')) for tile in payload['tiles'])
+            viewer.adaptive.record_sent(size, now - (viewer.encode_started or frame.timestamp))
+        if not viewer.binary:
+            payload = fallback or self._to_base64(payload)
+        self.socketio.emit('frame', payload, to=viewer.controller_sid)
+        viewer.last_sent_at = now
+        viewer.mark_sent(frame, now)
+        self._count(viewer, 'frames_sent')
+
+    def _send_video(self, stream: CaptureStream, frame: CapturedFrame, viewer: ViewerState,
+                    quality: int, params: EncodeParams) -> None:
+        """Encode a frame into a controller's video stream and emit it"""
+        width, height = scaled_size(frame, params.scale)
+        settings = (stream.key, 'video', viewer.video['codec'], viewer.video['bitrate'],
+                    viewer.video['keyframe_interval'], width - width % 2, height - height % 2)
+        keyframe = viewer.needs_keyframe(settings)
+        if not keyframe and viewer.last_hash == frame.content_hash:
+            self._send_unchanged(viewer, frame)
+            return
+
+        encoder = viewer.video_encoder
+        if encoder is None or settings != viewer.params:
+            # New area, size or codec settings: start a new stream
+            if encoder:
+                encoder.close()
+                viewer.video_encoder = None
+            try:
+                encoder = viewer.video_encoder = VideoEncoder(
+                    viewer.video['codec'], width, height, self.max_fps, viewer.video['bitrate'],
+                    viewer.video['keyframe_interval'])
+            except Exception as e:
+                logger.error(f"Error starting video encoder, falling back to tiles: {e}")
+                viewer.video = None
+                viewer.keyframe_requested = True
+                self.socketio.emit('video_mode', {'enabled': False}, to=viewer.controller_sid)
+                return
+            keyframe = True
+        viewer.params = settings
+
+        packets = self.encoder_pool.execute(encoder.encode, frame, keyframe)
+        if not packets:
+            self._send_unchanged(viewer, frame)
+            return
+        data = b''.join(packet for packet, _ in packets)
+        message = {
+            'frame_id': frame.frame_id,
+            'keyframe': packets[0][1],
+            'codec': encoder.codec_string,
+            'width': encoder.width,
+            'height': encoder.height,
+            'timestamp': frame.timestamp,
+            'quality': quality,
+            'monitor': stream.monitor,
+            'region': list(stream.region) if stream.region else None
+        }
+        if viewer.binary:
+            message['data'] = data
+        else:
+            message['chunk'] = base64.b64encode(data).decode('utf-8')
+
+        now = time.time()
+        if viewer.adaptive:
+            viewer.adaptive.record_sent(len(data), now - (viewer.encode_started or frame.timestamp))
+        self.socketio.emit('video_frame', message, to=viewer.controller_sid)
+        viewer.last_sent_at = now
+        viewer.mark_sent(frame, now)
+        self._count(viewer, 'frames_sent')
+
+    def _cache_keyframe(self, stream: CaptureStream, frame: CapturedFrame, params: EncodeParams, payload: dict,
+                        viewers: List[ViewerState]) -> None:
+        """Keep a self-contained full-screen update for controllers joining the sessions later"""
+        if stream.key != (None, None) or payload['copies'] or not self._covers_frame(payload):
+            return  # only the default view is shown on join
+        tiles = [{name: value for name, value in tile.items() if name != 'key'} for tile in payload['tiles']]
+        cached = {
+            'stream_key': stream.key,
+            'params': params,
+            'content_hash': frame.content_hash,
+            'payload': dict(payload, keyframe=True, tiles=tiles)
+        }
+        for viewer in viewers:
+            session = self.session_manager.get_session(viewer.session_id)
+            if session:
+                session.last_keyframe = cached
+
+    @staticmethod
+    def _apply_tile_cache(cache: TileCache, payload: dict) -> dict:
+        """Replace tiles the controller already holds with references and assign slots to new ones"""
+        tiles = payload['tiles']
+        if len(tiles) > cache.capacity:
+            # Storing would evict tiles this very frame refers to
+            return dict(payload, tiles=[{name: value for name, value in tile.items() if name != 'key'}
+                                        for tile in tiles])
+
+        # Look up references first so stores only evict tiles this frame does not use
+        slots = [cache.lookup(tile['key']) if tile.get('key') else None for tile in tiles]
+        result = []
+        for tile, slot in zip(tiles, slots):
+            key = tile.get('key')
+            tile = {name: value for name, value in tile.items() if name != 'key'}
+            if key is None:
+                result.append(tile)
+                continue
+            if slot is None:
+                slot = cache.lookup(key)  # stored by an earlier tile of this frame
+            if slot is not None:
+                result.append({'x': tile['x'], 'y': tile['y'], 'w': tile['w'], 'h': tile['h'], 'ref': slot})
+            else:
+                result.append(dict(tile, cache_slot=cache.store(key)))
+        return dict(payload, tiles=result)
+
+    @staticmethod
+    def _covers_frame(payload: dict) -> bool:
+        """Check whether an update redraws the whole picture"""
+        return payload['keyframe'] or any(
+            tile['w'] == payload['width'] and tile['h'] == payload['height'] for tile in payload['tiles'])
+
+    def _refine_tiles(self, stream: CaptureStream, frame: CapturedFrame, viewer: ViewerState,
+                      params: EncodeParams) -> List[dict]:
+        """Re-encode tiles that stayed static since they were last sent at a low quality"""
+        static_frame_id = stream.static_frame_id
+        versions = stream.tracker.versions
+        if (not viewer.refine or params.quality >= REFINE_QUALITY or static_frame_id is None
+                or versions is None or viewer.last_frame_id is None):
+            return []
+        if viewer.refined_at is None or viewer.refined_at.shape != versions.shape:
+            viewer.refined_at = np.zeros(versions.shape, dtype=np.int64)
+
+        # Static, already held by the controller, and changed since the last refinement
+        mask = ((versions <= min(static_frame_id, viewer.last_frame_id))
+                & (viewer.refined_at < versions))
+        candidates = np.flatnonzero(mask)
+        if not len(candidates):
+            return []
+        mask = np.zeros_like(mask)
+        mask.flat[candidates[:REFINE_TILES_PER_FRAME]] = True
+
+        tile_size = stream.tracker.tile_size
+        palettes = None
+        if self._is_native(frame, params):
+            # Palette tiles went out losslessly already; only photographic ones gain anything
+            single = tile_rects(mask, frame.width, frame.height, tile_size, merge=False)
+            lossless = np.zeros_like(mask)
+            for x, y, _, _ in self.encoder_pool.classify(frame, single):
+                lossless[y // tile_size, x // tile_size] = True
+            viewer.refined_at[lossless] = frame.frame_id
+            mask &= ~lossless
+            palettes = {}
+        rects = tile_rects(mask, frame.width, frame.height, tile_size)
+        if not rects:
+            return []
+        tiles = self.encoder_pool.encode_tiles(frame, rects, params._replace(quality=REFINE_QUALITY),
+                                               palettes=palettes)
+        if tiles:
+            viewer.refined_at[mask] = frame.frame_id
+        return tiles or []
+
+    def _send_unchanged(self, viewer: ViewerState, frame: CapturedFrame) -> None:
+        """Tell a controller its picture is current without sending image data"""
+        if viewer.frame_requested:
+            # Polling controllers wait for a reply; streaming ones need no message at all
+            self.socketio.emit('frame_unchanged', {
+                'frame_id': frame.frame_id,
+                'timestamp': frame.timestamp
+            }, to=viewer.controller_sid)
+        viewer.mark_unchanged(frame, time.time())
+
+    def _send_cursor(self) -> None:
+        """Send cursor moves and new shapes to controllers, separately from frames"""
+        if self.cursor_tracker is None or not self._streams:
+            return
+        cursor = self.cursor_tracker.poll()
+        if cursor is None:
+            return
+
+        for viewer in list(self._viewers.values()):
+            stream = self._streams.get(viewer.stream_key)
+            if (stream is None or stream.area is None or viewer.last_frame_id is None
+                    or not viewer.visible):
+                continue
+            left, top, width, height = stream.area
+            x = (cursor.x - left) / width
+            y = (cursor.y - top) / height
+            shape = cursor.shape
+            visible = cursor.visible and shape is not None and 0 <= x < 1 and 0 <= y < 1
+            state = (round(x, 4), round(y, 4), visible, shape.shape_id if visible else None)
+            if state == viewer.cursor_sent:
+                continue
+
+            if visible and shape.shape_id not in viewer.cursor_shapes:
+                message = {
+                    'shape': shape.shape_id,
+                    'width': shape.width,
+                    'height': shape.height,
+                    'hotspot_x': shape.hotspot_x,
+                    'hotspot_y': shape.hotspot_y
+                }
+                if viewer.binary:
+                    message['data'] = shape.data
+                else:
+                    message['image'] = base64.b64encode(shape.data).decode('utf-8')
+                self.socketio.emit('cursor_shape', message, to=viewer.controller_sid)
+                viewer.cursor_shapes.add(shape.shape_id)
+
+            self.socketio.emit('cursor', {
+                'x': state[0],
+                'y': state[1],
+                'visible': visible,
+                'shape': state[3],
+                'area_width': width,
+                'area_height': height
+            }, to=viewer.controller_sid)
+            viewer.cursor_sent = state
+
+    def _count(self, viewer: ViewerState, counter: str) -> None:
+        """Increment a per-session delivery counter"""
+        session = self.session_manager.get_session(viewer.session_id)
+        if session:
+            setattr(session, counter, getattr(session, counter, 0) + 1)
+
+    def _build_update(self, stream: CaptureStream, frame: CapturedFrame, quality: int,
+                      params: EncodeParams, base_frame_id: Optional[int], cached: bool = False) -> Optional[dict]:
+        """Encode the tiles a controller holding base_frame_id is missing"""
+        mask = stream.tracker.changed_since(base_frame_id)
+        keyframe = mask is None
+        copies = []
+        moved = stream.tracker.moved_since(base_frame_id)
+        if moved:
+            # Scrolled or dragged content is copied on the controller canvas
+            move, move_mask = moved
+            copy = self._scaled_move(frame, params, move)
+            if copy:
+                copies.append(copy)
+                mask = move_mask
+        full_rect = [(0, 0, frame.width, frame.height)]
+        keys = None
+        palettes = None
+        if self._is_native(frame, params):
+            # Each tile is classified as palette or photographic on its own
+            if keyframe:
+                mask = np.ones(stream.tracker.grid, dtype=bool)
+            tile_size = stream.tracker.tile_size
+            rects = tile_rects(mask, frame.width, frame.height, tile_size, merge=False)
+            palettes = self.encoder_pool.classify(frame, rects) if rects else {}
+            if cached:
+                # Single tiles keyed by content, so tiles the controller holds become references.
+                # Scaled tiles are never keyed: their size and resampling depend on where they sit
+                if rects:
+                    keys = self.encoder_pool.execute(tile_keys, frame, rects, params)
+            else:
+                # Photographic tiles go out as merged runs, or as one image when they dominate
+                photo = mask.copy()
+                for x, y, _, _ in palettes:
+                    photo[y // tile_size, x // tile_size] = False
+                if photo.mean() > FULL_FRAME_THRESHOLD:
+                    rects, palettes = full_rect, {}
+                    copies = []
+                else:
+                    rects = list(palettes) + tile_rects(photo, frame.width, frame.height, tile_size)
+        elif keyframe:
+            rects = full_rect
+        elif mask.mean() > FULL_FRAME_THRESHOLD:
+            rects = full_rect
+            copies = []
+        else:
+            rects = tile_rects(mask, frame.width, frame.height, stream.tracker.tile_size)
+
+        tiles = self.encoder_pool.encode_tiles(frame, rects, params, keys, palettes) if rects else []
+        if tiles is None:
+            # The base frame stays put, so the next update covers the failed areas again
+            return None
+
+        width, height = scaled_size(frame, params.scale)
+        return self._payload(stream, frame, quality, width, height, keyframe, tiles, copies)
+
+    @staticmethod
+    def _payload(stream: CaptureStream, frame: CapturedFrame, quality: int, width: int, height: int,
+                 keyframe: bool, tiles: List[dict], copies: List[dict]) -> dict:
+        """Frame update message as emitted to controllers"""
+        return {
+            'frame_id': frame.frame_id,
+            'keyframe': keyframe,
+            'width': width,
+            'height': height,
+            'tiles': tiles,
+            'copies': copies,
+            'timestamp': frame.timestamp,
+            'quality': quality,
+            'monitor': stream.monitor,
+            'region': list(stream.region) if stream.region else None
+        }
+
+    @staticmethod
+    def _is_native(frame: CapturedFrame, params: EncodeParams) -> bool:
+        """Check whether a frame is sent at capture resolution, where tiles may go out losslessly"""
+        return scaled_size(frame, params.scale) == (frame.width, frame.height)
+
+    @staticmethod
+    def _scaled_move(frame: CapturedFrame, params: EncodeParams, move: tuple) -> Optional[dict]:
+        """Map a pixel move to output coordinates, or None if it does not land on whole pixels"""
+        width, height = scaled_size(frame, params.scale)
+        scale_x, scale_y = width / frame.width, height / frame.height
+        src_x, src_y, x, y, w, h = move
+        scaled = (src_x * scale_x, src_y * scale_y, x * scale_x, y * scale_y, w * scale_x, h * scale_y)
+        if any(abs(value - round(value)) > 1e-6 for value in scaled):
+            return None
+        return dict(zip(('src_x', 'src_y', 'x', 'y', 'w', 'h'), (int(round(v)) for v in scaled)))
+
+    @staticmethod
+    def _to_base64(payload: dict) -> dict:
+        """Fallback payload for controllers that cannot take binary attachments"""
+        tiles = []
+        for tile in payload['tiles']:
+            tile = {name: value for name, value in tile.items() if name != 'key'}
+            if 'data' in tile:
+                tile['image'] = base64.b64encode(tile.pop('data')).decode('utf-8')
+            tiles.append(tile)
+        return dict(payload, tiles=tiles)
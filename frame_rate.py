@@ -0,0 +1,49 @@
+import math
+from typing import Optional
+
+import numpy as np
+
+# Keepalive rate for a screen that is not changing
+DEFAULT_MIN_FPS = 2
+
+# Fraction of changed tiles that counts as full motion (scrolling, video, dragging)
+MOTION_RATIO = 0.02
+
+# Activity halves this often once the screen stops changing
+ACTIVITY_HALF_LIFE = 0.5  # seconds
+IDLE_ACTIVITY = 0.01  # below this the stream runs at the keepalive rate
+
+
+class FrameRateGovernor:
+    """Track how much one capture area is changing and turn it into a frame rate"""
+
+    def __init__(self):
+        self.activity = 1.0  # 0 quiescent .. 1 full motion; start fast so the first frames arrive quickly
+        self.change_ratio = 0.0  # fraction of tiles changed in the last capture
+        self._updated_at: Optional[float] = None
+
+    def update(self, changed: np.ndarray, now: float) -> None:
+        """Feed the changed tile mask of a new capture"""
+        self.change_ratio = float(changed.mean()) if changed.size else 0.0
+        level = min(1.0, self.change_ratio / MOTION_RATIO)
+        # Motion raises the rate at once, calm lowers it gradually
+        self.activity = max(level, self._decayed(now))
+        self._updated_at = now
+
+    def wake(self, now: float) -> None:
+        """Expect changes, e.g. because the controller just sent input"""
+        self.activity = 1.0
+        self._updated_at = now
+
+    def fps(self, min_fps: int, max_fps: int, now: float) -> int:
+        """Frame rate between the session limits for the current activity"""
+        activity = self._decayed(now)
+        if activity < IDLE_ACTIVITY:
+            return min_fps
+        return max(min_fps, min(max_fps, math.ceil(min_fps + (max_fps - min_fps) * activity)))
+
+    def _decayed(self, now: float) -> float:
+        """Activity as of now, decayed since the last capture"""
+        if self._updated_at is None:
+            return self.activity
+        return self.activity * 0.5 ** (max(0.0, now - self._updated_at) / ACTIVITY_HALF_LIFE)
@@ -0,0 +1,191 @@
+import io
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+from PIL import Image, features
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGRA, TJSAMP_444, TJSAMP_422, TJSAMP_420
+except ImportError:
+    TurboJPEG = None
+
+logger = logging.getLogger(__name__)
+
+# Codecs in order of preference when a controller supports several
+DEFAULT_CODEC_PREFERENCE = ['webp', 'jpeg']
+DEFAULT_LOSSLESS_PREFERENCE = ['webp-lossless', 'png']
+
+# Codecs every controller can decode
+FALLBACK_CODEC = 'jpeg'
+FALLBACK_LOSSLESS_CODEC = 'png'
+
+# Supported JPEG chroma subsampling modes
+JPEG_SUBSAMPLING_MODES = ('4:4:4', '4:2:2', '4:2:0')
+
+
+class ImageCodec:
+    """Encode tile images into one browser-decodable format"""
+
+    def __init__(self, name: str, mime_type: str, pil_format: str, lossless: bool = False,
+                 options: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.mime_type = mime_type
+        self.pil_format = pil_format
+        self.lossless = lossless
+        self.options = options or {}
+
+    @property
+    def format(self) -> str:
+        """Image subtype the controller decodes, e.g. 'webp'"""
+        return self.mime_type.split('/', 1)[1]
+
+    @property
+    def available(self) -> bool:
+        """Check whether the installed Pillow can write this format"""
+        if self.pil_format == 'WEBP':
+            return features.check('webp')
+        return True
+
+    def encode(self, image: Image.Image, quality: int) -> bytes:
+        """Encode an image; quality is ignored by lossless codecs"""
+        output = io.BytesIO()
+        if self.lossless:
+            image.save(output, format=self.pil_format, **self.options)
+        else:
+            image.save(output, format=self.pil_format, quality=quality, **self.options)
+        return output.getvalue()
+
+    def encode_pixels(self, pixels: np.ndarray, quality: int) -> Optional[bytes]:
+        """Encode a (height, width, 4) view of BGRX bytes directly, if this codec can"""
+        return None
+
+
+class JpegCodec(ImageCodec):
+    """JPEG via libjpeg-turbo straight from BGRA pixels when available, else via Pillow"""
+
+    def __init__(self, subsampling: str = '4:2:0'):
+        super().__init__('jpeg', 'image/jpeg', 'JPEG')
+        self.subsampling = subsampling
+        self._turbo = None
+        if TurboJPEG is not None:
+            try:
+                self._turbo = TurboJPEG()
+                logger.info("Using libjpeg-turbo for JPEG encoding")
+            except Exception as e:
+                logger.error(f"Error loading libjpeg-turbo, falling back to Pillow: {e}")
+
+    @property
+    def subsampling(self) -> str:
+        return self._subsampling
+
+    @subsampling.setter
+    def subsampling(self, value: str) -> None:
+        if value not in JPEG_SUBSAMPLING_MODES:
+            raise ValueError(f"Unsupported JPEG subsampling {value}")
+        self._subsampling = value
+
+    def encode(self, image: Image.Image, quality: int) -> bytes:
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=quality, subsampling=self.subsampling)
+        return output.getvalue()
+
+    def encode_pixels(self, pixels: np.ndarray, quality: int) -> Optional[bytes]:
+        if self._turbo is None:
+            return None
+        # Tile views keep the frame's row stride, so nothing is copied
+        subsample = {'4:4:4': TJSAMP_444, '4:2:2': TJSAMP_422, '4:2:0': TJSAMP_420}[self.subsampling]
+        return self._turbo.encode(pixels, quality=quality, pixel_format=TJPF_BGRA, jpeg_subsample=subsample)
+
+
+class CodecStats:
+    """Encode time and output size per codec, shared by the encoder threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, codec: str, pixels: int, size: int, seconds: float) -> None:
+        """Record one encode"""
+        with self._lock:
+            stats = self._stats.setdefault(codec, {'tiles': 0, 'pixels': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['tiles'] += 1
+            stats['pixels'] += pixels
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Totals plus bytes per pixel and encode time per megapixel for each codec"""
+        with self._lock:
+            summary = {}
+            for codec, stats in self._stats.items():
+                megapixels = stats['pixels'] / 1e6
+                summary[codec] = dict(
+                    stats,
+                    bytes_per_pixel=round(stats['bytes'] / stats['pixels'], 4) if stats['pixels'] else 0,
+                    ms_per_megapixel=round(stats['seconds'] * 1000 / megapixels, 2) if megapixels else 0
+                )
+            return summary
+
+
+_codecs: Dict[str, ImageCodec] = {}
+codec_stats = CodecStats()
+
+
+def register_codec(codec: ImageCodec) -> None:
+    """Make a codec available for negotiation"""
+    if not codec.available:
+        logger.info(f"Image codec {codec.name} not supported by this Pillow build")
+        return
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str) -> ImageCodec:
+    """Look up a codec, falling back to JPEG"""
+    return _codecs.get(name) or _codecs[FALLBACK_CODEC]
+
+
+def available_codecs() -> List[str]:
+    """Names of the registered codecs"""
+    return list(_codecs)
+
+
+def negotiate(supported: Optional[List[str]], preference: Optional[List[str]] = None,
+              lossless: bool = False) -> str:
+    """Pick the most preferred codec of a kind that both sides support"""
+    supported = set(supported or [])
+    default = DEFAULT_LOSSLESS_PREFERENCE if lossless else DEFAULT_CODEC_PREFERENCE
+    for name in preference or default:
+        codec = _codecs.get(name)
+        if codec and codec.lossless == lossless and name in supported:
+            return name
+    return FALLBACK_LOSSLESS_CODEC if lossless else FALLBACK_CODEC
+
+
+def encode_image(name: str, image: Image.Image, quality: int) -> bytes:
+    """Encode an image with a registered codec and record its cost"""
+    codec = get_codec(name)
+    started = time.perf_counter()
+    data = codec.encode(image, quality)
+    codec_stats.record(codec.name, image.width * image.height, len(data), time.perf_counter() - started)
+    return data
+
+
+def encode_pixels(name: str, pixels: np.ndarray, quality: int) -> Optional[bytes]:
+    """Encode a (height, width, 4) view of BGRX bytes without an intermediate image, or None if the codec cannot"""
+    codec = get_codec(name)
+    started = time.perf_counter()
+    data = codec.encode_pixels(pixels, quality)
+    if data is not None:
+        codec_stats.record(codec.name, pixels.shape[0] * pixels.shape[1], len(data), time.perf_counter() - started)
+    return data
+
+
+register_codec(JpegCodec())
+register_codec(ImageCodec('webp', 'image/webp', 'WEBP', options={'method': 2}))
+# For lossless WebP quality is the compression effort
+register_codec(ImageCodec('webp-lossless', 'image/webp', 'WEBP', lossless=True,
+                          options={'lossless': True, 'quality': 25, 'method': 1}))
+register_codec(ImageCodec('png', 'image/png', 'PNG', lossless=True, options={'compress_level': 3}))
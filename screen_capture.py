@@ -0,0 +1,182 @@
+import time
+import logging
+import traceback
+from typing import Optional, List, Dict, Any
+
+import mss
+import mss.exception
+
+logger = logging.getLogger(__name__)
+
+# How often to re-enumerate monitors to detect display reconfiguration
+DISPLAY_CHECK_INTERVAL = 2.0  # seconds
+
+# Smallest region of interest that will be captured
+MIN_REGION_SIZE = 16  # pixels
+
+
+class CapturedFrame:
+    """Raw screen capture in BGRA byte order"""
+
+    def __init__(self, frame_id: int, monitor: Dict[str, int], size: tuple, raw: bytearray):
+        self.frame_id = frame_id
+        self.monitor = monitor
+        self.size = size  # (width, height)
+        self.raw = raw
+        self.timestamp = time.time()
+        self.content_hash: Optional[int] = None  # filled in by change detection
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def area(self) -> tuple:
+        """Captured screen rectangle as (left, top, width, height)"""
+        return (self.monitor['left'], self.monitor['top'], self.width, self.height)
+
+
+class CaptureEngine:
+    """Long-lived screen capture engine owning a single mss handle"""
+
+    def __init__(self, monitor_index: int = 1):
+        self.monitor_index = monitor_index
+        self._sct = None
+        self._monitors: List[Dict[str, Any]] = []
+        self._last_display_check = 0.0
+        self._frame_counter = 0
+
+    @property
+    def running(self) -> bool:
+        return self._sct is not None
+
+    def start(self) -> None:
+        """Open the mss handle and enumerate monitors"""
+        if self._sct is not None:
+            return
+        try:
+            self._sct = mss.mss()
+            self._monitors = [dict(m) for m in self._sct.monitors]
+            self._last_display_check = time.time()
+            logger.info(f"Capture engine started with {len(self._monitors) - 1} monitor(s)")
+        except Exception as e:
+            logger.error(f"Error starting capture engine: {e}")
+            traceback.print_exc()
+            self._sct = None
+            raise
+
+    def stop(self) -> None:
+        """Release the mss handle and its buffers"""
+        if self._sct is None:
+            return
+        try:
+            self._sct.close()
+        except Exception as e:
+            logger.error(f"Error stopping capture engine: {e}")
+        finally:
+            self._sct = None
+            self._monitors = []
+            logger.info("Capture engine stopped")
+
+    def restart(self) -> None:
+        """Reopen the mss handle, e.g. after a display reconfiguration"""
+        logger.info("Restarting capture engine")
+        self.stop()
+        self.start()
+
+    def _check_display(self) -> None:
+        """Restart the engine if the monitor layout changed"""
+        now = time.time()
+        if now - self._last_display_check < DISPLAY_CHECK_INTERVAL:
+            return
+        self._last_display_check = now
+        try:
+            with mss.mss() as probe:
+                monitors = [dict(m) for m in probe.monitors]
+            if monitors != self._monitors:
+                logger.info("Display configuration changed")
+                self.restart()
+        except Exception as e:
+            logger.error(f"Error checking display configuration: {e}")
+
+    def monitors(self) -> List[Dict[str, Any]]:
+        """Enumerate capturable monitors; index 0 is the union of all displays"""
+        try:
+            if self._sct is None:
+                # Listing monitors must not leave capture running for nobody
+                with mss.mss() as probe:
+                    self._monitors = [dict(m) for m in probe.monitors]
+            else:
+                self._check_display()
+            return [
+                {
+                    'index': index,
+                    'left': monitor['left'],
+                    'top': monitor['top'],
+                    'width': monitor['width'],
+                    'height': monitor['height'],
+                    'primary': index == 1
+                }
+                for index, monitor in enumerate(self._monitors)
+            ]
+        except Exception as e:
+            logger.error(f"Error enumerating monitors: {e}")
+            return []
+
+    def _get_monitor(self, monitor_index: Optional[int] = None) -> Dict[str, Any]:
+        """Get a monitor by index, falling back to the configured and then the primary one"""
+        for index in (monitor_index, self.monitor_index):
+            if index is not None and 0 <= index < len(self._monitors):
+                return self._monitors[index]
+        return self._monitors[1] if len(self._monitors) > 1 else self._monitors[0]
+
+    @staticmethod
+    def _region_area(monitor: Dict[str, Any], region: Optional[tuple]) -> Dict[str, int]:
+        """Convert a normalized (x, y, width, height) region to a pixel area of the monitor"""
+        area = {key: monitor[key] for key in ('left', 'top', 'width', 'height')}
+        if not region:
+            return area
+
+        x, y, w, h = (min(max(float(v), 0.0), 1.0) for v in region)
+        width = max(MIN_REGION_SIZE, int(w * monitor['width']))
+        height = max(MIN_REGION_SIZE, int(h * monitor['height']))
+        width = min(width, monitor['width'])
+        height = min(height, monitor['height'])
+        left = min(int(x * monitor['width']), monitor['width'] - width)
+        top = min(int(y * monitor['height']), monitor['height'] - height)
+        area.update({
+            'left': monitor['left'] + left,
+            'top': monitor['top'] + top,
+            'width': width,
+            'height': height
+        })
+        return area
+
+    def grab(self, region: Optional[tuple] = None,
+             monitor_index: Optional[int] = None) -> Optional[CapturedFrame]:
+        """Capture a monitor (the configured one by default), or a normalized region of it"""
+        try:
+            if self._sct is None:
+                self.start()
+            else:
+                self._check_display()
+
+            monitor = self._region_area(self._get_monitor(monitor_index), region)
+            try:
+                screenshot = self._sct.grab(monitor)
+            except mss.exception.ScreenShotError as e:
+                # Handles become invalid when displays are reconfigured
+                logger.warning(f"Screen grab failed, restarting capture engine: {e}")
+                self.restart()
+                monitor = self._region_area(self._get_monitor(monitor_index), region)
+                screenshot = self._sct.grab(monitor)
+
+            self._frame_counter += 1
+            return CapturedFrame(self._frame_counter, monitor, tuple(screenshot.size), screenshot.raw)
+        except Exception as e:
+            logger.error(f"Error grabbing screen: {e}")
+            return None
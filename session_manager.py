@@ -14,6 +14,8 @@ class Session:
         self.start_time = datetime.datetime.now()
         self.last_activity = datetime.datetime.now()
         self.active = True
+        self.frames_sent = 0
+        self.frames_dropped_stale = 0
 
     def update_activity(self):
         """Update last activity timestamp"""
@@ -182,7 +184,9 @@ class SessionManager:
                     active_sessions.append({
                         'id': session_id,
                         'client_name': session.client_name,
-                        'num_controllers': len(session.controllers)
+                        'num_controllers': len(session.controllers),
+                        'frames_sent': session.frames_sent,
+                        'frames_dropped_stale': session.frames_dropped_stale
                     })
             logger.info(f"Active sessions: {len(active_sessions)}")
             return active_sessions
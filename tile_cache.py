@@ -0,0 +1,85 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from screen_capture import CapturedFrame
+from frame_diff import frame_pixels
+
+# Bounds for the number of tiles a controller may offer to keep
+MAX_TILE_CACHE_SIZE = 4096
+DEFAULT_TILE_CACHE_SIZE = 1024
+
+# Encoded tiles kept on the server so repeated content is never encoded twice
+DEFAULT_STORE_BYTES = 64 * 1024 * 1024
+
+
+def tile_keys(frame: CapturedFrame, rects: List[Tuple[int, int, int, int]], params: tuple) -> List[bytes]:
+    """Content keys of frame regions sent at capture resolution, distinct for different encode settings"""
+    pixels = frame_pixels(frame)
+    settings = repr(params).encode()
+    keys = []
+    for x, y, w, h in rects:
+        digest = hashlib.blake2b(np.ascontiguousarray(pixels[y:y + h, x:x + w]), digest_size=16)
+        digest.update(f'{w}x{h}'.encode())
+        digest.update(settings)
+        keys.append(digest.digest())
+    return keys
+
+
+class TileStore:
+    """Server-side LRU of encoded tiles by content key, bounded in bytes"""
+
+    def __init__(self, max_bytes: int = DEFAULT_STORE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._tiles: OrderedDict = OrderedDict()  # key -> (format, data)
+        self.hits = 0
+
+    def get(self, key: bytes) -> Optional[Tuple[str, bytes]]:
+        """Look up an encoded tile, marking it recently used"""
+        entry = self._tiles.get(key)
+        if entry is not None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, key: bytes, tile: Dict[str, Any]) -> None:
+        """Keep an encoded tile, evicting the least recently used ones past the byte budget"""
+        if key in self._tiles or len(tile['data']) > self.max_bytes:
+            return
+        self._tiles[key] = (tile['format'], tile['data'])
+        self.size += len(tile['data'])
+        while self.size > self.max_bytes:
+            _, (_, data) = self._tiles.popitem(last=False)
+            self.size -= len(data)
+
+
+class TileCache:
+    """Server mirror of the tiles one controller holds, which decides all evictions"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._slots: OrderedDict = OrderedDict()  # key -> controller slot, least recently used first
+        self._free = list(range(capacity - 1, -1, -1))
+        self.hits = 0
+        self.stores = 0
+
+    def lookup(self, key: bytes) -> Optional[int]:
+        """Slot holding a tile on the controller, marking it recently used"""
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._slots.move_to_end(key)
+            self.hits += 1
+        return slot
+
+    def store(self, key: bytes) -> int:
+        """Assign a slot for a tile the controller is about to receive, reusing the oldest if full"""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            _, slot = self._slots.popitem(last=False)
+        self._slots[key] = slot
+        self.stores += 1
+        return slot
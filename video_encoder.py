@@ -0,0 +1,104 @@
+import logging
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+try:
+    import av
+except ImportError:
+    av = None
+
+from screen_capture import CapturedFrame
+from frame_diff import frame_bgra
+
+logger = logging.getLogger(__name__)
+
+# Codec name -> (FFmpeg encoder, encoder options)
+VIDEO_CODECS = {
+    'h264': ('libx264', {'preset': 'ultrafast', 'tune': 'zerolatency', 'profile': 'baseline'}),
+    'vp8': ('libvpx', {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0'}),
+    'vp9': ('libvpx-vp9', {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0',
+                           'row-mt': '1'}),
+}
+
+DEFAULT_VIDEO_BITRATE = 4_000_000  # bits per second
+MIN_VIDEO_BITRATE = 250_000
+MAX_VIDEO_BITRATE = 50_000_000
+DEFAULT_KEYFRAME_INTERVAL = 120  # frames
+
+
+def available_video_codecs() -> List[str]:
+    """Video codecs this host can encode"""
+    if av is None:
+        return []
+    return [name for name, (encoder, _) in VIDEO_CODECS.items() if encoder in av.codecs_available]
+
+
+def codec_string(codec: str, width: int, height: int) -> str:
+    """WebCodecs codec string for a stream of the given size"""
+    if codec == 'h264':
+        # Constrained baseline; the level only has to cover the frame size
+        if width * height <= 1280 * 720:
+            level = '1F'
+        elif width * height <= 2048 * 1088:
+            level = '28'
+        else:
+            level = '33'
+        return f'avc1.42E0{level}'
+    if codec == 'vp9':
+        return 'vp09.00.41.08'
+    return codec
+
+
+class VideoEncoder:
+    """Stateful software video encoder for one controller"""
+
+    def __init__(self, codec: str, width: int, height: int, fps: int,
+                 bitrate: int = DEFAULT_VIDEO_BITRATE, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL):
+        if av is None:
+            raise RuntimeError("PyAV is not installed")
+        encoder, options = VIDEO_CODECS[codec]
+        self.codec = codec
+        # 4:2:0 chroma needs even dimensions
+        self.width = max(2, width - width % 2)
+        self.height = max(2, height - height % 2)
+        self.codec_string = codec_string(codec, self.width, self.height)
+
+        self._context = av.CodecContext.create(encoder, 'w')
+        self._context.width = self.width
+        self._context.height = self.height
+        self._context.pix_fmt = 'yuv420p'
+        self._context.time_base = Fraction(1, 1000)
+        self._context.framerate = Fraction(fps, 1)
+        self._context.bit_rate = bitrate
+        self._context.gop_size = keyframe_interval
+        self._context.options = dict(options)
+        self._context.open()
+        self._first_timestamp: Optional[float] = None
+        self._last_pts = -1
+        logger.info(f"Video encoder {encoder} {self.width}x{self.height} at {bitrate // 1000} kbps")
+
+    def encode(self, frame: CapturedFrame, keyframe: bool = False) -> List[Tuple[bytes, bool]]:
+        """Encode one frame, returning (data, is_keyframe) packets ready to send"""
+        if self._first_timestamp is None:
+            self._first_timestamp = frame.timestamp
+        # Millisecond timestamps keep rate control right with variable frame pacing
+        pts = max(self._last_pts + 1, int((frame.timestamp - self._first_timestamp) * 1000))
+        self._last_pts = pts
+
+        picture = av.VideoFrame.from_ndarray(frame_bgra(frame), format='bgra')
+        picture = picture.reformat(width=self.width, height=self.height, format='yuv420p')
+        picture.pts = pts
+        if keyframe:
+            picture.pict_type = av.video.frame.PictureType.I
+
+        return [(bytes(packet), packet.is_keyframe) for packet in self._context.encode(picture)]
+
+    def close(self) -> None:
+        """Drain and release the codec context"""
+        if self._context is None:
+            return
+        try:
+            self._context.encode(None)
+        except Exception as e:
+            logger.error(f"Error closing video encoder: {e}")
+        self._context = None
@@ -17,16 +17,16 @@ import traceback
 from datetime import datetime
 from typing import Optional, Dict, Any
 
-import numpy as np
 from flask import Flask, render_template, request, redirect, url_for, session, Response, jsonify
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
-from PIL import Image, ImageGrab
-import io
-import base64
-import mss
-import mss.tools
 from session_manager import SessionManager
+from screen_capture import CaptureEngine
+from frame_encoder import QUALITY_SETTINGS, EncoderPool
+from frame_producer import FrameProducer
+from cursor_tracker import CursorTracker
+from image_codecs import available_codecs, codec_stats, get_codec
+from adaptive_quality import AUTO_QUALITY
 from input_handler import InputHandler
 
 # Configure logging
@@ -111,66 +111,30 @@ def get_local_ip():
         logger.error(f"Error getting local IP: {e}")
         return "127.0.0.1"
 
-# Screen capture configuration
-QUALITY_SETTINGS = {
-    1: {'quality': 10, 'resize': 0.25},  # Low quality
-    2: {'quality': 30, 'resize': 0.5},   # Medium quality
-    3: {'quality': 50, 'resize': 0.75},  # High quality
-    4: {'quality': 70, 'resize': 1.0}    # Best quality
-}
+# Long-lived capture engine for the primary monitor
+capture_engine = CaptureEngine(monitor_index=1)
 
-def capture_screen() -> bytes:
-    """Capture screen and return as JPEG bytes"""
-    try:
-        with mss.mss() as sct:
-            # Capture primary monitor
-            monitor = sct.monitors[1]
-            screenshot = sct.grab(monitor)
-            
-            # Convert to PIL Image
-            img = Image.frombytes('RGB', screenshot.size, screenshot.rgb)
-            
-            # Convert to JPEG
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG', quality=70)
-            img_byte_arr.seek(0)
-            
-            return img_byte_arr.getvalue()
-    except Exception as e:
-        logger.error(f"Error capturing screen: {e}")
-        return b''
-
-def process_frame(frame_bytes: bytes, quality_level: int = 4) -> str:
-    """Process frame with quality settings and return as base64"""
-    try:
-        # Get quality settings
-        settings = QUALITY_SETTINGS.get(quality_level, QUALITY_SETTINGS[4])
-        quality = settings['quality']
-        resize = settings['resize']
-        
-        # Open image
-        img = Image.open(io.BytesIO(frame_bytes))
-        
-        # Resize if needed
-        if resize < 1.0:
-            new_size = tuple(int(dim * resize) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Convert to JPEG
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='JPEG', quality=quality)
-        img_byte_arr.seek(0)
-        
-        # Convert to base64
-        return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-    except Exception as e:
-        logger.error(f"Error processing frame: {e}")
-        return ''
+# Worker threads used for frame encoding
+ENCODER_POOL_SIZE = int(os.environ.get('ENCODER_POOL_SIZE', 4))
+encoder_pool = EncoderPool(ENCODER_POOL_SIZE)
 
 # Initialize managers
 session_manager = SessionManager()
 input_handler = InputHandler()
 
+# Host cursor is sent on its own channel instead of inside frames
+cursor_tracker = CursorTracker()
+
+# JPEG chroma subsampling: 4:2:0 is smallest, 4:4:4 keeps colored text crisp
+get_codec('jpeg').subsampling = os.environ.get('JPEG_SUBSAMPLING', '4:2:0')
+
+# Preferred tile codecs, most preferred first; controllers get the first one they support
+IMAGE_CODECS = [name.strip() for name in os.environ.get('IMAGE_CODECS', '').split(',') if name.strip()]
+
+# Shared frame producer for all controllers of this host
+frame_producer = FrameProducer(socketio_server, session_manager, capture_engine, encoder_pool,
+                               cursor_tracker, codec_preference=IMAGE_CODECS or None)
+
 @app.after_request
 def add_header(response):
     """Add headers to allow screen capture and other features"""
@@ -228,6 +192,18 @@ def get_connection_info():
         logger.error(f"Error getting connection info: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/codec-stats')
+def get_codec_stats():
+    """Get encode time and output size per image codec"""
+    try:
+        return jsonify({
+            'available': available_codecs(),
+            'stats': codec_stats.summary()
+        })
+    except Exception as e:
+        logger.error(f"Error getting codec stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @socketio_server.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
@@ -236,6 +212,7 @@ def handle_disconnect():
         logger.info(f"Client disconnected: {client_sid}")
         
         # Clean up any sessions this client was part of
+        frame_producer.remove_controller(client_sid)
         session_manager.remove_client(client_sid)
         
         # Broadcast updated session list
@@ -318,6 +295,33 @@ def handle_join_session(data):
             
             logger.info(f"Client {request.sid} joined session {session_id}")
             emit('joined_session', {'session_id': session_id})
+            
+            # Settings sent with the join apply before the cached keyframe, so it stays the base of later deltas
+            if data.get('codecs'):
+                negotiated = frame_producer.set_codecs(session_id, request.sid, data.get('codecs'))
+                if negotiated:
+                    emit('codecs_negotiated', negotiated)
+            viewport = data.get('viewport')
+            if viewport:
+                frame_producer.set_viewport(
+                    session_id,
+                    request.sid,
+                    width=viewport.get('width', 0),
+                    height=viewport.get('height', 0),
+                    dpr=viewport.get('dpr', 1.0)
+                )
+            if data.get('tile_cache'):
+                result = frame_producer.set_tile_cache(session_id, request.sid, data.get('tile_cache'))
+                if result:
+                    emit('tile_cache_ready', result)
+            
+            # Show the screen right away from the last keyframe while the first capture is encoded
+            frame_producer.send_cached_keyframe(
+                session_id,
+                request.sid,
+                binary=bool(data.get('binary')),
+                codecs=data.get('codecs')
+            )
             broadcast_sessions()
         else:
             logger.error(f"Failed to join session {session_id}")
@@ -331,6 +335,7 @@ def handle_leave_session(data):
     """Handle session leave request"""
     try:
         session_id = data.get('session_id')
+        frame_producer.remove_controller(request.sid)
         session_manager.leave_session(session_id, request.sid)
         emit('left_session', {'session_id': session_id})
         logger.info(f"Client {request.sid} left session {session_id}")
@@ -364,6 +369,9 @@ def handle_keyboard_event(data):
             
         logger.debug(f"Processing keyboard event: {key} ({event_type})")
         
+        # Input usually changes the screen; raise the frame rate before it does
+        frame_producer.notify_input(session_id)
+        
         # Handle special key combinations
         if key.startswith('Control+'):
             if key == 'Control+c':
@@ -399,23 +407,204 @@ def handle_frame_request(data):
             logger.error(f"No session found for ID {session_id}")
             return
             
-        # Get quality setting
-        quality = getattr(session, 'quality', 4)
-        
-        # Capture and process frame
-        frame_bytes = capture_screen()
-        if frame_bytes:
-            frame_base64 = process_frame(frame_bytes, quality)
-            if frame_base64:
-                emit('frame', {
-                    'image': frame_base64,
-                    'timestamp': time.time(),
-                    'quality': quality
-                })
+        # Optional region of interest in normalized screen coordinates
+        if 'region' in data:
+            frame_producer.set_region(session_id, request.sid, data.get('region'))
+
+        # Queue for the next frame produced for this host
+        frame_producer.request_frame(
+            session_id,
+            request.sid,
+            keyframe=bool(data.get('keyframe')),
+            binary=bool(data.get('binary'))
+        )
     except Exception as e:
         logger.error(f"Error handling frame request: {e}")
         emit('error', {'message': str(e)})
 
+@socketio_server.on('start_stream')
+def handle_start_stream(data):
+    """Handle request to push frames to a controller"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for stream start")
+            return
+            
+        if frame_producer.start_stream(
+            session_id,
+            request.sid,
+            fps=int(data.get('fps', 30)),
+            credits=int(data.get('credits', 2)),
+            binary=bool(data.get('binary'))
+        ):
+            emit('stream_started', {'session_id': session_id})
+        else:
+            emit('error', {'message': 'Failed to start stream'})
+    except Exception as e:
+        logger.error(f"Error starting stream: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('stop_stream')
+def handle_stop_stream(data):
+    """Handle request to stop pushing frames to a controller"""
+    try:
+        frame_producer.stop_stream(request.sid)
+    except Exception as e:
+        logger.error(f"Error stopping stream: {e}")
+
+@socketio_server.on('frame_ack')
+def handle_frame_ack(data):
+    """Handle frame acknowledgement, returning a stream credit"""
+    try:
+        frame_id = data.get('frame_id')
+        if frame_id is not None:
+            frame_producer.ack_frame(request.sid, int(frame_id))
+    except Exception as e:
+        logger.error(f"Error handling frame ack: {e}")
+
+@socketio_server.on('list_monitors')
+def handle_list_monitors(data=None):
+    """Send the host's monitors to a controller"""
+    try:
+        emit('monitors', {
+            'monitors': capture_engine.monitors(),
+            'default': capture_engine.monitor_index
+        })
+    except Exception as e:
+        logger.error(f"Error listing monitors: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('select_monitor')
+def handle_select_monitor(data):
+    """Switch the monitor a controller watches"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for monitor selection")
+            return
+            
+        monitor = data.get('monitor')
+        if frame_producer.select_monitor(session_id, request.sid, monitor):
+            emit('monitor_changed', {'monitor': monitor})
+        else:
+            emit('error', {'message': 'Failed to select monitor'})
+    except Exception as e:
+        logger.error(f"Error selecting monitor: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_codecs')
+def handle_set_codecs(data):
+    """Handle the list of image formats a controller can decode"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for codec negotiation")
+            return
+            
+        negotiated = frame_producer.set_codecs(session_id, request.sid, data.get('codecs'))
+        if negotiated:
+            emit('codecs_negotiated', negotiated)
+    except Exception as e:
+        logger.error(f"Error negotiating codecs: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_video_mode')
+def handle_set_video_mode(data):
+    """Switch a controller between image tiles and a video stream"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for video mode")
+            return
+            
+        result = frame_producer.set_video_mode(
+            session_id,
+            request.sid,
+            enabled=bool(data.get('enabled')),
+            codecs=data.get('codecs'),
+            bitrate=data.get('bitrate'),
+            keyframe_interval=data.get('keyframe_interval')
+        )
+        if result:
+            emit('video_mode', result)
+    except Exception as e:
+        logger.error(f"Error setting video mode: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_visibility')
+def handle_set_visibility(data):
+    """Pause or resume frames while the controller tab is hidden or shown"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for visibility change")
+            return
+            
+        frame_producer.set_visibility(session_id, request.sid, bool(data.get('visible', True)))
+    except Exception as e:
+        logger.error(f"Error setting visibility: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_frame_rate')
+def handle_set_frame_rate(data):
+    """Handle the keepalive and full-motion frame rates of a session"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for frame rate")
+            return
+            
+        limits = frame_producer.set_frame_rate(
+            session_id,
+            request.sid,
+            min_fps=data.get('min_fps'),
+            max_fps=data.get('max_fps')
+        )
+        if limits:
+            emit('frame_rate_changed', limits)
+        else:
+            emit('error', {'message': 'Failed to set frame rate'})
+    except Exception as e:
+        logger.error(f"Error setting frame rate: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_tile_cache')
+def handle_set_tile_cache(data):
+    """Handle the number of tiles a controller offers to cache"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for tile cache")
+            return
+            
+        result = frame_producer.set_tile_cache(session_id, request.sid, data.get('size', 0))
+        if result:
+            emit('tile_cache_ready', result)
+    except Exception as e:
+        logger.error(f"Error setting tile cache: {e}")
+        emit('error', {'message': str(e)})
+
+@socketio_server.on('set_viewport')
+def handle_set_viewport(data):
+    """Handle controller canvas size report"""
+    try:
+        session_id = data.get('session_id')
+        if not session_id:
+            logger.error("No session_id provided for viewport update")
+            return
+            
+        frame_producer.set_viewport(
+            session_id,
+            request.sid,
+            width=data.get('width', 0),
+            height=data.get('height', 0),
+            dpr=data.get('dpr', 1.0)
+        )
+    except Exception as e:
+        logger.error(f"Error setting viewport: {e}")
+        emit('error', {'message': str(e)})
+
 @socketio_server.on('set_quality')
 def handle_set_quality(data):
     """Handle quality change request"""
@@ -423,12 +612,21 @@ def handle_set_quality(data):
         session_id = data.get('session_id')
         quality = int(data.get('quality', 4))
         
-        if session_id and quality in QUALITY_SETTINGS:
+        if session_id and (quality in QUALITY_SETTINGS or quality == AUTO_QUALITY):
             session = session_manager.get_session(session_id)
             if session:
                 session.quality = quality
                 logger.info(f"Set quality to {quality} for session {session_id}")
                 emit('quality_changed', {'quality': quality})
+
+        # Progressive refinement of static tiles, per controller
+        if session_id and 'refine' in data:
+            frame_producer.set_refinement(session_id, request.sid, data.get('refine'))
+
+        # Zoom applies to this controller only
+        if session_id and 'region' in data:
+            if frame_producer.set_region(session_id, request.sid, data.get('region')):
+                emit('region_changed', {'region': data.get('region')})
     except Exception as e:
         logger.error(f"Error setting quality: {e}")
         emit('error', {'message': str(e)})
@@ -489,3 +687,6 @@ if __name__ == "__main__":
         logger.error(f"Server error: {e}")
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        frame_producer.stop()
+        capture_engine.stop()